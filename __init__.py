@@ -14,22 +14,26 @@ from magento_ import (
     ExportInventoryStart, ExportInventory, StorePriceTier,
     ExportTierPricesStart, ExportTierPrices, ExportTierPricesStatus,
     ExportShipmentStatusStart, ExportShipmentStatus, ImportOrderStatesStart,
-    ImportOrderStates, ImportCarriersStart, ImportCarriers, MagentoException
+    ImportOrderStates, ImportCarriersStart, ImportCarriers, MagentoException,
+    StoreTierPriceFingerprint
 )
 from party import Party, MagentoWebsiteParty, Address
 from product import (
     Category, MagentoInstanceCategory, Template, MagentoWebsiteTemplate,
-    ImportCatalogStart, ImportCatalog, UpdateCatalogStart, UpdateCatalog,
-    ProductPriceTier, ExportCatalogStart, ExportCatalog
+    ImportCatalogStart, ImportCatalogStatus, ImportCatalog, UpdateCatalogStart,
+    UpdateCatalog, ProductPriceTier, ExportCatalogStart, ExportCatalogStatus,
+    ExportCatalog
 )
 from country import Country, Subdivision
 from currency import Currency
 from carrier import MagentoInstanceCarrier
 from sale import (
     MagentoOrderState, Sale, ImportOrdersStart, ImportOrders,
-    ExportOrderStatusStart, ExportOrderStatus, StockShipmentOut, SaleLine
+    ExportOrderStatusStart, ExportOrderStatus, StockShipmentOut, SaleLine,
+    SaleStateChange
 )
 from bom import BOM
+from stock import Move
 from tax import StoreViewTax, StoreViewTaxRelation
 
 
@@ -59,9 +63,12 @@ def register():
         MagentoInstanceCategory,
         Template,
         MagentoWebsiteTemplate,
+        StoreTierPriceFingerprint,
         ProductPriceTier,
         ImportCatalogStart,
+        ImportCatalogStatus,
         ExportCatalogStart,
+        ExportCatalogStatus,
         MagentoOrderState,
         StockShipmentOut,
         Address,
@@ -73,7 +80,9 @@ def register():
         ImportCarriersStart,
         ExportOrderStatusStart,
         SaleLine,
+        SaleStateChange,
         BOM,
+        Move,
         StoreViewTax,
         StoreViewTaxRelation,
         module='magento', type_='model'
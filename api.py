@@ -7,9 +7,93 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import sys
+import threading
+from Queue import Queue, Empty
+
+import magento
 from magento.api import API
 
 
+def multicall_in_chunks(api, calls, chunk_size=100):
+    """
+    Sends the calls to magento as multiCalls of `chunk_size` calls each,
+    using the session already opened on the api
+
+    :param api: API on which a session is open
+    :param calls: List of calls where each call is a list of the resource
+                  path and the list of arguments.
+
+               Example :
+                   [['catalog_product.info', [1]], ...]
+    :param chunk_size: Number of calls to be sent in one multiCall
+    :return: List of results in the same order as the calls. The result of
+             a call which failed on magento is a dictionary with `isFault`,
+             `faultCode` and `faultMessage`
+    """
+    results = []
+    for index in xrange(0, len(calls), chunk_size):
+        results.extend(api.multiCall(calls[index:index + chunk_size]))
+    return results
+
+
+def is_fault(result):
+    """
+    Returns True if the result of a call in a multiCall is a fault
+    """
+    return isinstance(result, dict) and bool(result.get('isFault'))
+
+
+def fetch_products_info(instance, magento_ids, workers=4):
+    """
+    Fetches the details of the products from magento with `workers`
+    sessions working in parallel. Only the calls to magento are made in the
+    worker threads, so that the results can then be used in the current
+    transaction.
+
+    :param instance: Active record of magento instance
+    :param magento_ids: List of product IDs on magento
+    :param workers: Maximum number of sessions opened in parallel
+    :return: Dictionary of product data with magento ID as key
+    """
+    # The records can not be read from the worker threads, which have no
+    # transaction
+    url, api_user, api_key = instance.url, instance.api_user, instance.api_key
+
+    queue = Queue()
+    for magento_id in magento_ids:
+        queue.put(magento_id)
+
+    results = {}
+    errors = []
+
+    def fetch():
+        try:
+            with magento.Product(url, api_user, api_key) as product_api:
+                while not errors:
+                    try:
+                        magento_id = queue.get_nowait()
+                    except Empty:
+                        break
+                    results[magento_id] = product_api.info(magento_id)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target=fetch)
+        for _ in xrange(min(workers, len(magento_ids)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
 class Core(API):
     """
     This API extends the API for the custom API implementation
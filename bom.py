@@ -7,17 +7,134 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import json
+from decimal import Decimal
+
+from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 
 
 __all__ = ['BOM']
 __metaclass__ = PoolMeta
 
+#: Precision to which the quantities of the components of a bundle are
+#: rounded, so that ratios computed from different order quantities match
+QUANTITY_PRECISION = Decimal('0.0001')
+
 
 class BOM:
     "Bill of Material"
     __name__ = 'production.bom'
 
+    #: Hash of the bundle product and of its components with their
+    #: quantities, used to find the BoM matching a magento bundle
+    magento_signature = fields.Char(
+        'Magento Signature', readonly=True, select=True
+    )
+
+    @staticmethod
+    def round_component_quantity(quantity):
+        """
+        Returns the quantity of a component rounded to the precision used to
+        match BoMs
+
+        :param quantity: Quantity as a float, a string or a Decimal
+        :return: Decimal quantity
+        """
+        if isinstance(quantity, float):
+            quantity = repr(quantity)
+        return Decimal(quantity).quantize(QUANTITY_PRECISION)
+
+    @classmethod
+    def get_magento_signature(cls, product, components):
+        """
+        Returns the signature of a BoM producing the product from the
+        components. The components are sorted, so their order does not
+        change the signature.
+
+        :param product: ID of the bundle product
+        :param components: List of tuples of product ID and quantity of the
+                           components
+        :return: Hexadecimal signature
+        """
+        return hashlib.sha1(json.dumps([product, sorted(
+            (product_id, unicode(cls.round_component_quantity(quantity)))
+            for product_id, quantity in components
+        )])).hexdigest()
+
+    def compute_magento_signature(self, product):
+        """
+        Returns the signature of this BoM for the bundle product from its
+        inputs
+
+        :param product: Active record of the bundle product
+        :return: Hexadecimal signature
+        """
+        return self.get_magento_signature(product.id, [
+            (input.product.id, input.quantity) for input in self.inputs
+        ])
+
+    def is_magento_bundle_bom(self, product, unit):
+        """
+        Returns True if this BoM has the shape of the BoMs created for
+        magento bundles: a single output of the bundle product, and all the
+        inputs and outputs in units
+
+        :param product: Active record of the bundle product
+        :param unit: Active record of the unit UoM
+        """
+        return (
+            len(self.outputs) == 1 and
+            self.outputs[0].product == product and
+            all(
+                line.uom == unit
+                for line in list(self.inputs) + list(self.outputs)
+            )
+        )
+
+    @classmethod
+    def find_using_magento_signature(cls, product, signature):
+        """
+        Finds the BoM of the bundle product with the signature. The BoMs of
+        the product created for magento bundles before signatures were
+        stored get theirs on the first lookup, the other BoMs of the product
+        are left unsigned.
+
+        :param product: Active record of the bundle product
+        :param signature: Signature of the BoM
+        :return: Active record of the BoM or None
+        """
+        Uom = Pool().get('product.uom')
+
+        boms = cls.search([
+            ('magento_signature', '=', signature),
+        ], order=[('id', 'ASC')], limit=1)
+        if boms:
+            return boms[0]
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        unsigned = dict(
+            (product_bom.bom, product_bom.bom.compute_magento_signature(
+                product
+            ))
+            for product_bom in product.boms
+            if not product_bom.bom.magento_signature and
+            product_bom.bom.is_magento_bundle_bom(product, unit)
+        )
+        if not unsigned:
+            return None
+
+        args = []
+        for bom, bom_signature in unsigned.iteritems():
+            args.extend([[bom], {'magento_signature': bom_signature}])
+        cls.write(*args)
+
+        for bom in sorted(unsigned, key=lambda bom: bom.id):
+            if unsigned[bom] == signature:
+                return bom
+        return None
+
     @classmethod
     def identify_boms_from_magento_data(cls, order_data):
         """
@@ -56,16 +173,20 @@ class BOM:
     @classmethod
     def find_or_create_bom_for_magento_bundle(cls, order_data):
         """
-        Find or create a BoM for bundle product from the data sent in
-        magento order
+        Find or create a BoM for each bundle product from the data sent in
+        magento order, and link it to the bundle product
 
         :param order_data: Order Data from magento
-        :return: Found or created BoM's active record
+        :return: Active record of the product BoM linking the last bundle
+                 of the order to its found or created BoM, or None if the
+                 order has no bundle
         """
         Uom = Pool().get('product.uom')
         ProductTemplate = Pool().get('product.template')
         ProductBom = Pool().get('product.product-production.bom')
 
+        product_bom = None
+
         identified_boms = cls.identify_boms_from_magento_data(order_data)
 
         if not identified_boms:
@@ -79,42 +200,41 @@ class BOM:
             bundle_product = bundle_product_template.products[0]
 
             # It contains a list of tuples, in which the first element is the
-            # product's active record and second is its quantity in the BoM
+            # product's active record and second is its quantity in the BoM.
+            # The quantities are only rounded to compute the signature.
             child_products = [(
                 ProductTemplate.find_or_create_using_magento_id(
                     each['product_id']
                 ).products[0], (
-                    float(each['qty_ordered']) /
-                    float(data['bundle']['qty_ordered'])
+                    Decimal(each['qty_ordered']) /
+                    Decimal(data['bundle']['qty_ordered'])
                 )
             ) for each in data['components']]
 
-            # Here we match the sets of BoM components for equality
-            # Each set contains tuples of product and quantity of that
-            # product in the BoM
-            # If everything for a BoM matches, then we dont create a new one
-            # and use this BoM itself
-            # XXX This might eventually have issues because of rounding
-            # in quantity
-            for product_bom in bundle_product.boms:
-                existing_bom_set = set([
-                    (input.product.id, input.quantity)
-                    for input in product_bom.bom.inputs
-                ])
-                new_bom_set = set([
-                    (product.id, qty) for product, qty in child_products
-                ])
-                if existing_bom_set == new_bom_set:
-                    break
+            # The BoM with the same components in the same quantities is
+            # found by its signature, else a new one is created
+            signature = cls.get_magento_signature(bundle_product.id, [
+                (product.id, quantity) for product, quantity in child_products
+            ])
+            bom = cls.find_using_magento_signature(bundle_product, signature)
+            if bom:
+                product_boms = ProductBom.search([
+                    ('product', '=', bundle_product.id),
+                    ('bom', '=', bom.id),
+                ], limit=1)
+                if product_boms:
+                    product_bom, = product_boms
+                    continue
             else:
                 # No matching BoM found, create a new one
                 unit, = Uom.search([('name', '=', 'Unit')])
                 bom, = cls.create([{
                     'name': bundle_product.name,
+                    'magento_signature': signature,
                     'inputs': [('create', [{
                         'uom': unit.id,
                         'product': product.id,
-                        'quantity': quantity,
+                        'quantity': float(quantity),
                     }]) for product, quantity in child_products],
                     'outputs': [('create', [{
                         'uom': unit,
@@ -123,9 +243,9 @@ class BOM:
                     }])]
                 }])
 
-                product_bom = ProductBom.create([{
-                    'product': bundle_product.id,
-                    'bom': bom.id,
-                }])
+            product_bom, = ProductBom.create([{
+                'product': bundle_product.id,
+                'bom': bom.id,
+            }])
 
         return product_bom
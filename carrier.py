@@ -10,13 +10,15 @@
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.transaction import Transaction
 
+from .mixin import FindOrCreateMixin
+
 
 __all__ = [
     'MagentoInstanceCarrier'
 ]
 
 
-class MagentoInstanceCarrier(ModelSQL, ModelView):
+class MagentoInstanceCarrier(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Instance carrier
 
@@ -57,15 +59,24 @@ class MagentoInstanceCarrier(ModelSQL, ModelView):
         :param magento_data: List of Dictionary of carriers sent by magento
         :return: List of active records of carriers Created/Found
         """
-        carriers = []
-        for data in magento_data:
-            carrier = cls.find_using_magento_data(data)
-            if carrier:
-                carriers.append(carrier)
-            else:
-                # Create carrier if not found
-                carriers.append(cls.create_using_magento_data(data))
-        return carriers
+        return cls.find_or_create_all(('instance', 'code'), [
+            cls.get_values_from_magento_data(data) for data in magento_data
+        ])
+
+    @staticmethod
+    def get_values_from_magento_data(carrier_data):
+        """
+        Returns the values of the carrier sent by magento for the instance
+        in context
+
+        :param carrier_data: Dictionary of carrier sent by magento
+        :return: Dictionary of values of carrier
+        """
+        return {
+            'code': carrier_data['code'],
+            'title': carrier_data['label'],
+            'instance': Transaction().context['magento_instance'],
+        }
 
     @classmethod
     def create_using_magento_data(cls, carrier_data):
@@ -75,11 +86,9 @@ class MagentoInstanceCarrier(ModelSQL, ModelView):
         :param carrier_data: Dictionary of carrier sent by magento
         :return: Active record of carrier created
         """
-        carrier, = cls.create([{
-            'code': carrier_data['code'],
-            'title': carrier_data['label'],
-            'instance': Transaction().context['magento_instance'],
-        }])
+        carrier, = cls.create([
+            cls.get_values_from_magento_data(carrier_data)
+        ])
 
         return carrier
 
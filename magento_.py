@@ -9,15 +9,24 @@
 """
 import xmlrpclib
 import socket
+import hashlib
+import json
+import time
+import uuid
+from copy import deepcopy
 from datetime import datetime
+from decimal import Decimal
 
 import magento
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import PoolMeta, Pool
+from trytond.cache import Cache
 from trytond.transaction import Transaction
 from trytond.pyson import PYSONEncoder, Eval
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.wizard import Wizard, StateView, Button, StateAction
-from .api import OrderConfig, Core
+from .api import OrderConfig, Core, multicall_in_chunks, is_fault
+from .mixin import FindOrCreateMixin
 from .sale import SaleLine
 
 
@@ -28,7 +37,8 @@ __all__ = [
     'StorePriceTier', 'ExportTierPricesStart', 'ExportTierPrices',
     'ExportTierPricesStatus', 'ExportShipmentStatusStart',
     'ExportShipmentStatus', 'ImportOrderStatesStart', 'MagentoException',
-    'ImportOrderStates', 'ImportCarriersStart', 'ImportCarriers'
+    'ImportOrderStates', 'ImportCarriersStart', 'ImportCarriers',
+    'StoreTierPriceFingerprint',
 ]
 __metaclass__ = PoolMeta
 
@@ -61,6 +71,19 @@ class Instance(ModelSQL, ModelView):
         help="This helps to distinguish between orders from different "
             "instances"
     )
+    metadata_cache_ttl = fields.Integer(
+        'Metadata Cache Duration',
+        help="Number of seconds for which the metadata fetched from magento, "
+            "like attribute sets, order states or shipping methods, is kept "
+            "in cache. Zero disables the cache."
+    )
+    #: Random token changed to invalidate the metadata cached for this
+    #: instance in every process
+    metadata_cache_version = fields.Char(
+        'Metadata Cache Version', readonly=True
+    )
+
+    _metadata_cache = Cache('magento.instance.metadata', context=False)
 
     default_account_expense = fields.Property(fields.Many2One(
         'account.account', 'Account Expense', domain=[
@@ -84,29 +107,152 @@ class Instance(ModelSQL, ModelView):
         """
         return 'mag_'
 
+    @staticmethod
+    def default_metadata_cache_ttl():
+        """
+        Sets default duration of the metadata cache to one hour
+        """
+        return 3600
+
+    @staticmethod
+    def default_metadata_cache_version():
+        """
+        Sets a random version of the metadata cache
+        """
+        return uuid.uuid4().hex
+
+    def get_metadata(self, name, fetch, refresh=False):
+        """
+        Returns read-only metadata of this instance, fetching it from magento
+        only if it is not in cache or if it was cached more than
+        `metadata_cache_ttl` seconds ago
+
+        :param name: Name of the metadata, unique for the instance
+        :param fetch: Function called without arguments to fetch the
+                      metadata from magento
+        :param refresh: If True, the metadata is fetched from magento even if
+                        it is in cache, and the cache is refreshed with it
+        :return: Metadata as returned by `fetch`
+        """
+        key = (self.id, self.metadata_cache_version, name)
+        cached = None if refresh else self._metadata_cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return deepcopy(cached[1])
+
+        value = fetch()
+        if self.metadata_cache_ttl:
+            self._metadata_cache.set(
+                key, (time.time() + self.metadata_cache_ttl, deepcopy(value))
+            )
+        return value
+
     @classmethod
-    @ModelView.button_action('magento.wizard_import_order_states')
-    def import_order_states(cls, instances):
+    @ModelView.button
+    def clear_metadata_cache(cls, instances):
         """
-        Import order states for instances
+        Clears the metadata cached for the instances, so that it is fetched
+        again from magento the next time it is needed. The metadata of the
+        other instances stays in cache.
 
         :param instances: List of active records of instances
         """
-        OrderState = Pool().get('magento.order_state')
+        # The cache can only be cleared as a whole, so the version of the
+        # instances in the keys is changed instead. A random version never
+        # matches the keys cached by a transaction that was rolled back.
+        if instances:
+            cls.write(instances, {
+                'metadata_cache_version': cls.default_metadata_cache_version(),
+            })
 
-        for instance in instances:
+    def get_order_states(self, refresh=False):
+        """
+        Returns the order states of magento
 
-            Transaction().context.update({
-                'magento_instance': instance.id
-            })
+        :param refresh: If True, the cached value is not used, see
+                        :meth:`get_metadata`
+        :return: Dictionary of order state titles with state as key
+        """
+        def fetch():
+            with OrderConfig(
+                self.url, self.api_user, self.api_key
+            ) as order_config_api:
+                return order_config_api.get_states()
+        return self.get_metadata('order_states', fetch, refresh)
 
-            # Import order states
+    def get_shipping_methods(self, refresh=False):
+        """
+        Returns the shipping methods of magento
+
+        :param refresh: If True, the cached value is not used, see
+                        :meth:`get_metadata`
+        :return: List of dictionaries with the code and label of the
+                 shipping methods
+        """
+        def fetch():
             with OrderConfig(
-                instance.url, instance.api_user, instance.api_key
+                self.url, self.api_user, self.api_key
             ) as order_config_api:
-                OrderState.create_all_using_magento_data(
-                    order_config_api.get_states()
+                return order_config_api.get_shipping_methods()
+        return self.get_metadata('shipping_methods', fetch, refresh)
+
+    def get_attribute_sets(self):
+        """
+        Returns the product attribute sets of magento
+
+        :return: List of dictionaries with the ID and name of the attribute
+                 sets
+        """
+        def fetch():
+            with magento.ProductAttributeSet(
+                self.url, self.api_user, self.api_key
+            ) as attribute_set_api:
+                return attribute_set_api.list()
+        return self.get_metadata('attribute_sets', fetch)
+
+    def get_websites_data(self, refresh=False):
+        """
+        Returns the websites, stores and store views of magento, all fetched
+        in a single session
+
+        :param refresh: If True, the cached value is not used, see
+                        :meth:`get_metadata`
+        :return: Tuple of the lists of dictionaries of websites, stores and
+                 store views data
+        """
+        def fetch():
+            with Core(self.url, self.api_user, self.api_key) as core_api:
+                return (
+                    core_api.websites(),
+                    core_api.stores(),
+                    core_api.store_views(),
                 )
+        return self.get_metadata('websites', fetch, refresh)
+
+    @classmethod
+    @ModelView.button_action('magento.wizard_import_order_states')
+    def import_order_states(cls, instances):
+        """
+        Import order states for instances. The order states are fetched
+        again from magento, even if they are in cache.
+
+        :param instances: List of active records of instances
+        """
+        for instance in instances:
+            instance.import_order_states_from_magento(refresh=True)
+
+    def import_order_states_from_magento(self, refresh=False):
+        """
+        Import the order states of this instance
+
+        :param refresh: If True, the order states are fetched from magento
+                        even if they are in cache, see :meth:`get_metadata`
+        """
+        OrderState = Pool().get('magento.order_state')
+
+        with Transaction().set_context(magento_instance=self.id):
+            OrderState.create_all_using_magento_data(
+                self.get_order_states(refresh)
+            )
 
     @staticmethod
     def default_active():
@@ -145,6 +291,7 @@ class Instance(ModelSQL, ModelView):
             'import_websites': {},
             'import_order_states': {},
             'import_carriers': {},
+            'clear_metadata_cache': {},
         })
 
     @classmethod
@@ -174,91 +321,98 @@ class Instance(ModelSQL, ModelView):
     @ModelView.button_action('magento.wizard_import_websites')
     def import_websites(cls, instances):
         """
-        Import the websites and their stores/view from magento
+        Import the websites and their stores/view from magento. The
+        websites are fetched again from magento, even if they are in cache.
 
         :param instances: Active record list of magento instance
         """
-        Website = Pool().get('magento.instance.website')
-        Store = Pool().get('magento.website.store')
-        StoreView = Pool().get('magento.store.store_view')
-        MagentoOrderState = Pool().get('magento.order_state')
-
         try:
             instance, = instances
         except ValueError:
             cls.raise_user_error('multiple_instances')
 
-        with Transaction().set_context(magento_instance=instance.id):
+        instance.import_websites_from_magento(refresh=True)
 
-            # Import order states
-            with OrderConfig(
-                instance.url, instance.api_user, instance.api_key
-            ) as order_config_api:
-                MagentoOrderState.create_all_using_magento_data(
-                    order_config_api.get_states()
-                )
-
-            # Import websites
-            with Core(
-                instance.url, instance.api_user, instance.api_key
-            ) as core_api:
-                websites = []
-                stores = []
-
-                mag_websites = core_api.websites()
+    def import_websites_from_magento(self, refresh=False):
+        """
+        Import the websites and their stores/view of this instance, along
+        with its order states
 
-                # Create websites
-                for mag_website in mag_websites:
-                    websites.append(Website.find_or_create(
-                        instance, mag_website
-                    ))
+        :param refresh: If True, the websites are fetched from magento even
+                        if they are in cache, see :meth:`get_metadata`
+        """
+        Website = Pool().get('magento.instance.website')
+        Store = Pool().get('magento.website.store')
+        StoreView = Pool().get('magento.store.store_view')
 
-                for website in websites:
-                    mag_stores = core_api.stores(
-                        {'website_id': {'=': website.magento_id}}
-                    )
+        self.import_order_states_from_magento()
 
-                    # Create stores
-                    for mag_store in mag_stores:
-                        stores.append(Store.find_or_create(website, mag_store))
+        with Transaction().set_context(magento_instance=self.id):
 
-                for store in stores:
-                    mag_store_views = core_api.store_views(
-                        {'group_id': {'=': store.magento_id}}
-                    )
+            # Import websites, stores and store views. They are all fetched
+            # at once, and each level is then found or created in bulk under
+            # its parents.
+            mag_websites, mag_stores, mag_store_views = \
+                self.get_websites_data(refresh)
 
-                    # Create store views
-                    for mag_store_view in mag_store_views:
-                            store_view = StoreView.find_or_create(
-                                store, mag_store_view
-                            )
-                            # AR refactoring
-                            store_view.save()
+            websites = dict(
+                (website.magento_id, website)
+                for website in Website.find_or_create_all(
+                    ('instance', 'magento_id'), [
+                        Website.get_values_using_magento_data(
+                            self, mag_website
+                        ) for mag_website in mag_websites
+                    ]
+                )
+            )
+            stores = dict(
+                (store.magento_id, store)
+                for store in Store.find_or_create_all(
+                    ('website', 'magento_id'), [
+                        Store.get_values_using_magento_data(
+                            websites[int(mag_store['website_id'])], mag_store
+                        ) for mag_store in mag_stores
+                        if int(mag_store['website_id']) in websites
+                    ]
+                )
+            )
+            StoreView.find_or_create_all(('store', 'magento_id'), [
+                StoreView.get_values_using_magento_data(
+                    stores[int(mag_store_view['group_id'])], mag_store_view
+                ) for mag_store_view in mag_store_views
+                if int(mag_store_view['group_id']) in stores
+            ])
 
     @classmethod
     @ModelView.button_action('magento.wizard_import_carriers')
     def import_carriers(cls, instances):
         """
-        Import carriers/shipping methods from magento for instances
+        Import carriers/shipping methods from magento for instances. The
+        shipping methods are fetched again from magento, even if they are in
+        cache.
 
         :param instances: Active record list of magento instances
         """
-        InstanceCarrier = Pool().get('magento.instance.carrier')
-
         for instance in instances:
+            instance.import_carriers_from_magento(refresh=True)
 
-            with Transaction().set_context({
-                'magento_instance': instance.id
-            }):
-                with OrderConfig(
-                    instance.url, instance.api_user, instance.api_key
-                ) as order_config_api:
-                    mag_carriers = order_config_api.get_shipping_methods()
+    def import_carriers_from_magento(self, refresh=False):
+        """
+        Import the carriers/shipping methods of this instance
+
+        :param refresh: If True, the shipping methods are fetched from
+                        magento even if they are in cache, see
+                        :meth:`get_metadata`
+        """
+        InstanceCarrier = Pool().get('magento.instance.carrier')
 
-                InstanceCarrier.create_all_using_magento_data(mag_carriers)
+        with Transaction().set_context(magento_instance=self.id):
+            InstanceCarrier.create_all_using_magento_data(
+                self.get_shipping_methods(refresh)
+            )
 
 
-class InstanceWebsite(ModelSQL, ModelView):
+class InstanceWebsite(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Instance Website
 
@@ -275,7 +429,7 @@ class InstanceWebsite(ModelSQL, ModelView):
     )
     company = fields.Function(
         fields.Many2One('company.company', 'Company'),
-        'get_company'
+        'get_parent_fields', searcher='search_parent_field'
     )
     stores = fields.One2Many(
         'magento.website.store', 'website', 'Stores',
@@ -290,13 +444,42 @@ class InstanceWebsite(ModelSQL, ModelView):
         readonly=True
     )
 
-    def get_company(self, name):
-        """
-        Returns company related to instance
+    @classmethod
+    def get_parent_fields(cls, websites, names):
+        """
+        Returns the company of the instance of the websites
+
+        :param websites: List of active records of websites
+        :param names: Names of the fields
+        :return: Dictionary of values by website ID for each field
+        """
+        Instance = Pool().get('magento.instance')
+        cursor = Transaction().cursor
+        website = cls.__table__()
+        instance = Instance.__table__()
+
+        result = dict((name, {}) for name in names)
+        for sub_websites in grouped_slice(websites):
+            cursor.execute(*website.join(
+                instance, condition=website.instance == instance.id
+            ).select(
+                website.id, instance.company,
+                where=reduce_ids(website.id, [w.id for w in sub_websites])
+            ))
+            for website_id, company_id in cursor.fetchall():
+                values = {
+                    'company': company_id,
+                }
+                for name in names:
+                    result[name][website_id] = values[name]
+        return result
 
-        :param name: Field name
+    @classmethod
+    def search_parent_field(cls, name, clause):
+        """
+        Searches the company on the instance of the website
         """
-        return self.instance.company.id
+        return [('instance.' + clause[0],) + tuple(clause[1:])]
 
     @staticmethod
     def default_magento_root_category_id():
@@ -340,67 +523,294 @@ class InstanceWebsite(ModelSQL, ModelView):
         :param values: Dictionary of values for a website sent by magento
         :return: Active record of record created/found
         """
-        websites = cls.search([
-            ('instance', '=', instance.id),
-            ('magento_id', '=', int(values['website_id']))
-        ])
+        return cls.find_or_create_all(('instance', 'magento_id'), [
+            cls.get_values_using_magento_data(instance, values)
+        ])[0]
 
-        if websites:
-            return websites[0]
+    @staticmethod
+    def get_values_using_magento_data(instance, values):
+        """
+        Returns the values of the website whose `values` are sent by magento
+        for the instance with `instance` in tryton
 
-        return cls.create([{
+        :param instance: Active record of instance
+        :param values: Dictionary of values for a website sent by magento
+        :return: Dictionary of values of website
+        """
+        return {
             'name': values['name'],
             'code': values['code'],
             'instance': instance.id,
             'magento_id': int(values['website_id']),
-        }])[0]
+        }
 
-    def export_inventory(self, websites):
+    @classmethod
+    def export_inventory(cls, websites=None):
         """
-        Exports inventory stock information to magento
+        Exports inventory stock information to magento. This method is
+        called by cron. A single session is opened on each instance for all
+        its websites.
 
         :param websites: List of active records of website
         """
+        if websites is None:
+            websites = cls.search([])
+
+        websites_by_instance = {}
+        for website in websites:
+            websites_by_instance.setdefault(website.instance, []).append(
+                website
+            )
+
+        exported = set()
+        for instance, instance_websites in websites_by_instance.iteritems():
+            with magento.Inventory(
+                instance.url, instance.api_user, instance.api_key
+            ) as inventory_api:
+                for website in instance_websites:
+                    for magento_product_templates in \
+                            website.iter_magento_product_templates():
+                        cls.export_inventory_for_templates(
+                            magento_product_templates, exported,
+                            inventory_api
+                        )
+
+    @classmethod
+    def export_stock_changes(cls, websites=None):
+        """
+        Exports stock information to magento only for the products whose
+        stock changed since it was last exported. This method is called by
+        cron. The changed products are exported in chunks, over a single
+        session on each instance.
+
+        :param websites: List of active records of websites
+        """
+        MagentoProductTemplate = Pool().get('magento.website.template')
+
+        if websites is None:
+            websites = cls.search([])
+
+        websites_by_instance = {}
         for website in websites:
-            website.export_inventory_to_magento()
+            websites_by_instance.setdefault(website.instance, []).append(
+                website
+            )
+
+        exported = set()
+        for instance, instance_websites in websites_by_instance.iteritems():
+            magento_product_template_ids = map(
+                int, MagentoProductTemplate.search([
+                    ('website', 'in', map(int, instance_websites)),
+                    ('stock_dirty', '=', True),
+                ], order=[('id', 'ASC')])
+            )
+            if not magento_product_template_ids:
+                continue
+
+            with magento.Inventory(
+                instance.url, instance.api_user, instance.api_key
+            ) as inventory_api:
+                for sub_ids in grouped_slice(magento_product_template_ids):
+                    cls.export_inventory_for_templates(
+                        MagentoProductTemplate.browse(list(sub_ids)),
+                        exported, inventory_api
+                    )
+
+    def iter_magento_product_templates(self, chunk_size=1000):
+        """
+        Iterates over the magento product templates of this website in
+        chunks of `chunk_size` records, paging through them by ID instead of
+        loading all of them at once. The templates, products and price tiers
+        of each chunk are read together when the chunk is fetched, and a
+        chunk is released as soon as the next one is fetched.
+
+        :param chunk_size: Number of magento product templates in a chunk
+        :return: Iterator over lists of active records of magento product
+                 templates
+        """
+        MagentoProductTemplate = Pool().get('magento.website.template')
+
+        last_id = 0
+        while True:
+            magento_product_templates = MagentoProductTemplate.search([
+                ('website', '=', self.id),
+                ('id', '>', last_id),
+            ], order=[('id', 'ASC')], limit=chunk_size)
+            if not magento_product_templates:
+                break
+
+            # The records of a chunk share their cache, so accessing a field
+            # on one of them reads it for the whole chunk at once
+            for magento_product_template in magento_product_templates:
+                template = magento_product_template.template
+                template.products
+                for price_tier in template.price_tiers:
+                    price_tier.quantity
+
+            yield magento_product_templates
+
+            last_id = magento_product_templates[-1].id
 
     def export_inventory_to_magento(self):
         """
         Exports stock data of products from tryton to magento for this
-        website
+        website, over a single session on the instance
 
         :return: List of product templates
         """
-        Location = Pool().get('stock.location')
+        ProductTemplate = Pool().get('product.template')
 
-        product_templates = []
         instance = self.instance
+        template_ids = []
+        with magento.Inventory(
+            instance.url, instance.api_user, instance.api_key
+        ) as inventory_api:
+            for magento_product_templates in \
+                    self.iter_magento_product_templates():
+                template_ids.extend(map(
+                    int, self.export_inventory_for_templates(
+                        magento_product_templates, inventory_api=inventory_api
+                    )
+                ))
+        return ProductTemplate.browse(template_ids)
+
+    @classmethod
+    def export_inventory_for_templates(
+        cls, magento_product_templates, exported=None, inventory_api=None
+    ):
+        """
+        Exports stock data of the given products from tryton to magento.
+        The quantities are computed once for all the products, whichever
+        website they belong to, and a product is updated only once on an
+        instance even if it is linked to several websites of the instance.
+        The products whose stock status flips are exported first.
+
+        :param magento_product_templates: List of active records of magento
+                                          product templates
+        :param exported: Set of tuples of instance ID and magento ID of the
+                         products already updated, when the products are
+                         exported in several calls. It is updated in place.
+        :param inventory_api: Open session of magento inventory API on the
+                              instance of all the given products. If it is
+                              not given, a session is opened on each
+                              instance of the products.
+        :return: List of product templates
+        """
+        Location = Pool().get('stock.location')
+        ProductTemplate = Pool().get('product.template')
+        MagentoProductTemplate = Pool().get('magento.website.template')
 
         locations = Location.search([('type', '=', 'storage')])
 
-        for magento_product_template in self.magento_product_templates:
-            product_template = magento_product_template.template
-            product_templates.append(product_template)
+        with Transaction().set_context({'locations': map(int, locations)}):
+            quantities = dict(
+                (product_template.id, product_template.quantity)
+                for product_template in ProductTemplate.browse(list(set(
+                    magento_product_template.template.id
+                    for magento_product_template in magento_product_templates
+                )))
+            )
 
-            with Transaction().set_context({'locations': map(int, locations)}):
-                product_data = {
-                    'qty': product_template.quantity,
-                    'is_in_stock': '1' if product_template.quantity > 0
-                        else '0',
-                }
+        # Group the products by the instance and the product on magento,
+        # so that each product is updated once on each instance
+        updates_by_instance = {}
+        for magento_product_template in magento_product_templates:
+            updates_by_instance.setdefault(
+                magento_product_template.website.instance, {}
+            ).setdefault(
+                magento_product_template.magento_id, []
+            ).append(magento_product_template)
+
+        if exported is None:
+            exported = set()
+
+        in_stock, out_of_stock = [], []
+        for instance, updates in updates_by_instance.iteritems():
+            # Export the products whose stock status changes first, as they
+            # matter the most on the storefront
+            magento_ids = sorted(
+                updates,
+                key=lambda magento_id: all(
+                    (quantities[record.template.id] > 0) ==
+                    record.magento_is_in_stock
+                    for record in updates[magento_id]
+                )
+            )
 
-                # Update stock information to magento
+            for magento_id in magento_ids:
+                records = updates[magento_id]
+                if quantities[records[0].template.id] > 0:
+                    in_stock.extend(records)
+                else:
+                    out_of_stock.extend(records)
+
+            magento_ids = [
+                magento_id for magento_id in magento_ids
+                if (instance.id, magento_id) not in exported
+            ]
+            if not magento_ids:
+                continue
+
+            # Update stock information to magento
+            stock = [
+                (magento_id, quantities[updates[magento_id][0].template.id])
+                for magento_id in magento_ids
+            ]
+            if inventory_api is not None:
+                cls.update_inventory_on_magento(inventory_api, stock)
+            else:
                 with magento.Inventory(
                     instance.url, instance.api_user, instance.api_key
-                ) as inventory_api:
-                    inventory_api.update(
-                        magento_product_template.magento_id, product_data
+                ) as instance_inventory_api:
+                    cls.update_inventory_on_magento(
+                        instance_inventory_api, stock
                     )
+            exported.update(
+                (instance.id, magento_id) for magento_id in magento_ids
+            )
 
-        return product_templates
+        # Write only the links whose stock flags actually change
+        in_stock = [
+            record for record in in_stock
+            if record.stock_dirty or not record.magento_is_in_stock
+        ]
+        out_of_stock = [
+            record for record in out_of_stock
+            if record.stock_dirty or record.magento_is_in_stock
+        ]
+        if in_stock:
+            MagentoProductTemplate.write(in_stock, {
+                'stock_dirty': False,
+                'magento_is_in_stock': True,
+            })
+        if out_of_stock:
+            MagentoProductTemplate.write(out_of_stock, {
+                'stock_dirty': False,
+                'magento_is_in_stock': False,
+            })
+
+        return [
+            magento_product_template.template
+            for magento_product_template in magento_product_templates
+        ]
+
+    @classmethod
+    def update_inventory_on_magento(cls, inventory_api, stock):
+        """
+        Updates the stock of the given products on magento, using an open
+        magento session.
+
+        :param inventory_api: Open session of magento inventory API
+        :param stock: List of tuples of magento ID and quantity of products
+        """
+        for magento_id, quantity in stock:
+            inventory_api.update(magento_id, {
+                'qty': quantity,
+                'is_in_stock': '1' if quantity > 0 else '0',
+            })
 
 
-class WebsiteStore(ModelSQL, ModelView):
+class WebsiteStore(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Website Store or Store view groups
 
@@ -418,11 +828,11 @@ class WebsiteStore(ModelSQL, ModelView):
     )
     instance = fields.Function(
         fields.Many2One('magento.instance', 'Instance'),
-        'get_instance'
+        'get_parent_fields', searcher='search_parent_field'
     )
     company = fields.Function(
         fields.Many2One('company.company', 'Company'),
-        'get_company'
+        'get_parent_fields', searcher='search_parent_field'
     )
     store_views = fields.One2Many(
         'magento.store.store_view', 'store', 'Store Views', readonly=True
@@ -435,21 +845,48 @@ class WebsiteStore(ModelSQL, ModelView):
         'magento.store.price_tier', 'store', 'Default Price Tiers'
     )
 
-    def get_company(self, name):
+    @classmethod
+    def get_parent_fields(cls, stores, names):
         """
-        Returns company related to website
+        Returns the instance and the company of the website of the stores,
+        reading all of them with a single query
 
-        :param name: Field name
+        :param stores: List of active records of stores
+        :param names: Names of the fields
+        :return: Dictionary of values by store ID for each field
         """
-        return self.website.company.id
+        Website = Pool().get('magento.instance.website')
+        Instance = Pool().get('magento.instance')
+        cursor = Transaction().cursor
+        store = cls.__table__()
+        website = Website.__table__()
+        instance = Instance.__table__()
+
+        result = dict((name, {}) for name in names)
+        for sub_stores in grouped_slice(stores):
+            cursor.execute(*store.join(
+                website, condition=store.website == website.id
+            ).join(
+                instance, condition=website.instance == instance.id
+            ).select(
+                store.id, instance.id, instance.company,
+                where=reduce_ids(store.id, [s.id for s in sub_stores])
+            ))
+            for store_id, instance_id, company_id in cursor.fetchall():
+                values = {
+                    'instance': instance_id,
+                    'company': company_id,
+                }
+                for name in names:
+                    result[name][store_id] = values[name]
+        return result
 
-    def get_instance(self, name):
+    @classmethod
+    def search_parent_field(cls, name, clause):
         """
-        Returns instance related to website
-
-        :param name: Field name
+        Searches the instance or the company on the website of the store
         """
-        return self.website.instance.id
+        return [('website.' + clause[0],) + tuple(clause[1:])]
 
     @classmethod
     def __setup__(cls):
@@ -476,68 +913,274 @@ class WebsiteStore(ModelSQL, ModelView):
         :param values: Dictionary of values for a store sent by magento
         :return: Active record of record created/found
         """
-        stores = cls.search([
-            ('website', '=', website.id),
-            ('magento_id', '=', int(values['group_id']))
-        ])
+        return cls.find_or_create_all(('website', 'magento_id'), [
+            cls.get_values_using_magento_data(website, values)
+        ])[0]
 
-        if stores:
-            return stores[0]
+    @staticmethod
+    def get_values_using_magento_data(website, values):
+        """
+        Returns the values of the store whose `values` are sent by magento
+        for the website with `website` in tryton
 
-        return cls.create([{
+        :param website: Active record of website
+        :param values: Dictionary of values for a store sent by magento
+        :return: Dictionary of values of store
+        """
+        return {
             'name': values['name'],
             'magento_id': int(values['group_id']),
             'website': website.id,
-        }])[0]
+        }
+
+    @staticmethod
+    def compute_price_matrix(price_list, product_quantities, uom, cache=None):
+        """
+        Computes the prices from the price list for many pairs of product
+        and quantity in one pass, like :meth:`PriceList.compute` would for
+        each pair.
+
+        The lines of the price list matching a product are found once for
+        the product, and the quantities of the product only pick the first
+        of them whose minimum quantity they reach. The formula of a line is
+        evaluated once for each product, as it depends on the unit price of
+        the product and not on the quantity, so the tiers of a product
+        priced by the same line share the evaluation. Without price list,
+        the prices are the list prices of the products.
+
+        Prices already computed in the `cache` for the same price list,
+        product, quantity and uom are reused, and newly computed prices are
+        added to it, so that stores sharing a price list can share the
+        cache.
+
+        :param price_list: Active record of price list or None
+        :param product_quantities: List of tuples of product and quantity
+        :param uom: Active record of the uom of the quantities
+        :param cache: Dictionary of prices computed earlier
+        :return: Dictionary of prices with (product ID, quantity) as key
+        """
+        Uom = Pool().get('product.uom')
+
+        if cache is None:
+            cache = {}
+
+        price_list_id = price_list.id if price_list else None
+        lines_by_product = {}
+        line_prices = {}
+        prices = {}
+        for product, quantity in product_quantities:
+            key = (price_list_id, product.id, quantity, uom.id)
+            if key in cache:
+                prices[(product.id, quantity)] = cache[key]
+                continue
+
+            if product.id not in lines_by_product:
+                lines_by_product[product.id] = [
+                    line for line in (price_list.lines if price_list else [])
+                    if line.match({'product': product.id})
+                ]
+            product_quantity = Uom.compute_qty(
+                uom, quantity, product.default_uom, round=False
+            )
+            for line in lines_by_product[product.id]:
+                if not line.quantity > product_quantity:
+                    break
+            else:
+                line = None
+
+            if line is None:
+                price = product.list_price
+            elif (product.id, line.id) in line_prices:
+                price = line_prices[(product.id, line.id)]
+            else:
+                with Transaction().set_context(
+                    price_list._get_context_price_list_line(
+                        None, product, product.list_price, quantity, uom
+                    )
+                ):
+                    price = line_prices[(product.id, line.id)] = \
+                        line.get_unit_price()
+
+            cache[key] = prices[(product.id, quantity)] = price
+        return prices
 
-    def export_tier_prices_to_magento(self):
+    def get_price_tiers(self, product_template):
         """
-        Exports tier prices of products from tryton to magento for this store
+        Returns the price tiers from the product if the product has a price
+        tier table else the default price tiers from current store
 
-        :return: List of products
+        :param product_template: Active record of product template
+        :return: List of active records of price tiers
         """
-        instance = self.website.instance
+        return product_template.price_tiers or self.price_tiers
+
+    def get_tier_price_data(self, mag_product_template, prices=None):
+        """
+        Returns the tier prices of a product to be exported to magento for
+        this store
 
-        for mag_product_template in self.website.magento_product_templates:
-            product_template = mag_product_template.template
-            product = product_template.products[0]
+        :param mag_product_template: Active record of magento product template
+        :param prices: Dictionary of prices computed by
+                       :meth:`compute_price_matrix`. The prices are computed
+                       for this product if not given.
+        :return: List of dictionaries of quantity and price
+        """
+        product = mag_product_template.template.products[0]
+        price_tiers = self.get_price_tiers(mag_product_template.template)
 
-            # Get the price tiers from the product if the product has a price
-            # tier table else get the default price tiers from current store
-            price_tiers = product_template.price_tiers or self.price_tiers
+        if prices is None:
+            prices = self.compute_price_matrix(
+                self.price_list,
+                [(product, tier.quantity) for tier in price_tiers],
+                self.website.default_uom
+            )
 
-            price_data = []
-            for tier in price_tiers:
-                if hasattr(tier, 'product'):
-                    # The price tier comes from a product, then it has a
-                    # function field for price, we use it directly
-                    price = tier.price
-                else:
-                    # The price tier comes from the default tiers on store,
-                    # we dont have a product on tier, so we use the current
-                    # product in loop for computing the price for this tier
-                    price = self.price_list.compute(
-                        None, product, product.list_price, tier.quantity,
-                        self.website.default_uom
+        return [{
+            'qty': tier.quantity,
+            'price': float(prices[(product.id, tier.quantity)]),
+        } for tier in price_tiers]
+
+    @classmethod
+    def export_tier_prices(cls, stores=None):
+        """
+        Exports tier prices of products to magento for the stores. The
+        prices computed for a store are reused by the other stores having
+        the same price list.
+
+        :param stores: List of active records of stores
+        """
+        if stores is None:
+            stores = cls.search([('price_list', '!=', None)])
+
+        price_cache = {}
+        for store in stores:
+            store.export_tier_prices_to_magento(price_cache=price_cache)
+
+    def export_tier_prices_to_magento(
+        self, chunk_size=100, price_cache=None, force=False
+    ):
+        """
+        Exports tier prices of products from tryton to magento for this store.
+        Only the products whose tier prices changed since they were last
+        exported are sent, unless `force` is set. The updates are sent as
+        multiCalls of `chunk_size` products each, all in a single session,
+        and the products of the website are processed a chunk at a time, see
+        :meth:`InstanceWebsite.iter_magento_product_templates`.
+
+        :param chunk_size: Number of products updated in one multiCall
+        :param price_cache: Dictionary of prices computed earlier, see
+                            :meth:`compute_price_matrix`
+        :param force: If True, tier prices of all the products are exported
+        :return: Tuple of the count of products exported and a list of
+                 tuples of magento product template and fault message for
+                 the products which magento failed to update
+        """
+        instance = self.website.instance
+
+        exported_count = 0
+        failures = []
+
+        # Update tier prices information to magento
+        with magento.ProductTierPrice(
+            instance.url, instance.api_user, instance.api_key
+        ) as tier_price_api:
+            for mag_product_templates in \
+                    self.website.iter_magento_product_templates():
+                chunk_count, chunk_failures = \
+                    self.export_tier_prices_for_templates(
+                        tier_price_api, mag_product_templates, chunk_size,
+                        price_cache, force
                     )
+                exported_count += chunk_count
+                failures.extend(chunk_failures)
+
+        return exported_count, failures
+
+    def export_tier_prices_for_templates(
+        self, tier_price_api, mag_product_templates, chunk_size=100,
+        price_cache=None, force=False
+    ):
+        """
+        Exports tier prices of the given products from tryton to magento for
+        this store, using an open magento session.
+
+        :param tier_price_api: Open session of magento tier price API
+        :param mag_product_templates: List of active records of magento
+                                      product templates of the website
+        :param chunk_size: Number of products updated in one multiCall
+        :param price_cache: Dictionary of prices computed earlier, see
+                            :meth:`compute_price_matrix`
+        :param force: If True, tier prices of all the products are exported
+        :return: Tuple of the count of products exported and a list of
+                 tuples of magento product template and fault message for
+                 the products which magento failed to update
+        """
+        Fingerprint = Pool().get('magento.store.tier_price_fingerprint')
+
+        # Compute the prices of all the products at once
+        prices = self.compute_price_matrix(self.price_list, [
+            (mag_product_template.template.products[0], tier.quantity)
+            for mag_product_template in mag_product_templates
+            for tier in self.get_price_tiers(mag_product_template.template)
+        ], self.website.default_uom, price_cache)
+
+        fingerprints = dict(
+            (fingerprint.magento_product_template.id, fingerprint)
+            for fingerprint in Fingerprint.search([
+                ('store', '=', self.id),
+                ('magento_product_template', 'in',
+                    map(int, mag_product_templates)),
+            ])
+        )
 
-                price_data.append({
-                    'qty': tier.quantity,
-                    'price': float(price),
-                })
+        to_export = []
+        for mag_product_template in mag_product_templates:
+            price_data = self.get_tier_price_data(mag_product_template, prices)
+            fingerprint = Fingerprint.get_fingerprint(price_data)
+            existing = fingerprints.get(mag_product_template.id)
+            if not force and existing and \
+                    existing.fingerprint == fingerprint:
+                continue
+            to_export.append((mag_product_template, price_data, fingerprint))
+
+        calls = [
+            ['catalog_product_attribute_tier_price.update', [
+                template_link.magento_id, tier_data,
+            ]] for template_link, tier_data, _ in to_export
+        ]
+        results = multicall_in_chunks(tier_price_api, calls, chunk_size)
 
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                instance.url, instance.api_user, instance.api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    mag_product_template.magento_id, price_data
+        failures = []
+        to_create = []
+        to_write = []
+        for (mag_product_template, _, fingerprint), result in zip(
+            to_export, results
+        ):
+            if is_fault(result):
+                failures.append(
+                    (mag_product_template, result.get('faultMessage'))
                 )
+                continue
+
+            existing = fingerprints.get(mag_product_template.id)
+            if existing:
+                to_write.extend([[existing], {'fingerprint': fingerprint}])
+            else:
+                to_create.append({
+                    'store': self.id,
+                    'magento_product_template': mag_product_template.id,
+                    'fingerprint': fingerprint,
+                })
 
-        return len(self.website.magento_product_templates)
+        if to_create:
+            Fingerprint.create(to_create)
+        if to_write:
+            Fingerprint.write(*to_write)
 
+        return len(to_export) - len(failures), failures
 
-class WebsiteStoreView(ModelSQL, ModelView):
+
+class WebsiteStoreView(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Website Store View
 
@@ -555,15 +1198,15 @@ class WebsiteStoreView(ModelSQL, ModelView):
     )
     instance = fields.Function(
         fields.Many2One('magento.instance', 'Instance'),
-        'get_instance'
+        'get_parent_fields', searcher='search_parent_field'
     )
     website = fields.Function(
         fields.Many2One('magento.instance.website', 'Website'),
-        'get_website'
+        'get_parent_fields', searcher='search_parent_field'
     )
     company = fields.Function(
         fields.Many2One('company.company', 'Company'),
-        'get_company'
+        'get_parent_fields', searcher='search_parent_field'
     )
     last_order_import_time = fields.DateTime('Last Order Import Time')
     last_order_export_time = fields.DateTime("Last Order Export Time")
@@ -580,40 +1223,127 @@ class WebsiteStoreView(ModelSQL, ModelView):
         'reference on magento for the exported shipments as well.'
     )
 
+    #: Checking this will make guest orders with the email of an earlier
+    #: guest customer of the website use the party of that customer.
+    merge_guest_customers = fields.Boolean(
+        'Merge guest customers', help='Checking this will make the orders '
+        'of guest customers use the party of an earlier guest customer of '
+        'the website with the same email, instead of creating a new party '
+        'for each order.'
+    )
+
     taxes = fields.One2Many(
         "magento.store.store_view.tax", "store_view", "Taxes"
     )
 
-    def get_taxes(self, rate):
-        "Return list of tax records with the given rate"
-        for store_view_tax in self.taxes:
-            if store_view_tax.tax_percent == rate:
-                return list(store_view_tax.taxes)
-        return []
+    _tax_rates_cache = Cache(
+        'magento.store.store_view.tax_rates', context=False
+    )
+
+    @staticmethod
+    def default_merge_guest_customers():
+        return False
 
-    def get_instance(self, name):
+    @staticmethod
+    def normalize_tax_rate(rate):
         """
-        Returns instance related to store
+        Returns the rate rounded to the digits of the tax percent of store
+        view taxes, so that equal rates are equal keys
 
-        :param name: Field name
+        :param rate: Rate as a Decimal, for example 0.0825 for 8.25%
         """
-        return self.store.instance.id
+        return Decimal(rate).quantize(Decimal('0.0001'))
 
-    def get_website(self, name):
+    def get_tax_rate_map(self):
         """
-        Returns website related to store
+        Returns the taxes of this store view by rate. The map is cached
+        until the store view taxes change, and must not be modified.
 
-        :param name: Field name
+        :return: Dictionary of lists of tax IDs with the normalized rate as
+                 key
         """
-        return self.store.website.id
+        StoreViewTax = Pool().get('magento.store.store_view.tax')
+
+        tax_rate_map = self._tax_rates_cache.get(self.id)
+        if tax_rate_map is not None:
+            return tax_rate_map
 
-    def get_company(self, name):
+        tax_rate_map = {}
+        for store_view_tax in StoreViewTax.search_read([
+            ('store_view', '=', self.id),
+        ], fields_names=['tax_percent', 'taxes']):
+            tax_rate_map[
+                self.normalize_tax_rate(store_view_tax['tax_percent'])
+            ] = store_view_tax['taxes']
+        self._tax_rates_cache.set(self.id, tax_rate_map)
+        return tax_rate_map
+
+    @classmethod
+    def clear_tax_rate_cache(cls):
         """
-        Returns company related to store
+        Clears the taxes cached by rate for all the store views
+        """
+        cls._tax_rates_cache.clear()
 
-        :param name: Field name
+    def get_taxes(self, rate):
+        "Return list of tax records with the given rate"
+        Tax = Pool().get('account.tax')
+
+        return Tax.browse(
+            self.get_tax_rate_map().get(self.normalize_tax_rate(rate), [])
+        )
+
+    @classmethod
+    def get_parent_fields(cls, store_views, names):
+        """
+        Returns the website, the instance and the company of the store of
+        the store views, reading all of them with a single query
+
+        :param store_views: List of active records of store views
+        :param names: Names of the fields
+        :return: Dictionary of values by store view ID for each field
         """
-        return self.store.company.id
+        Store = Pool().get('magento.website.store')
+        Website = Pool().get('magento.instance.website')
+        Instance = Pool().get('magento.instance')
+        cursor = Transaction().cursor
+        store_view = cls.__table__()
+        store = Store.__table__()
+        website = Website.__table__()
+        instance = Instance.__table__()
+
+        result = dict((name, {}) for name in names)
+        for sub_store_views in grouped_slice(store_views):
+            cursor.execute(*store_view.join(
+                store, condition=store_view.store == store.id
+            ).join(
+                website, condition=store.website == website.id
+            ).join(
+                instance, condition=website.instance == instance.id
+            ).select(
+                store_view.id, website.id, instance.id, instance.company,
+                where=reduce_ids(
+                    store_view.id, [s.id for s in sub_store_views]
+                )
+            ))
+            for store_view_id, website_id, instance_id, company_id in \
+                    cursor.fetchall():
+                values = {
+                    'website': website_id,
+                    'instance': instance_id,
+                    'company': company_id,
+                }
+                for name in names:
+                    result[name][store_view_id] = values[name]
+        return result
+
+    @classmethod
+    def search_parent_field(cls, name, clause):
+        """
+        Searches the website, the instance or the company on the store of
+        the store view
+        """
+        return [('store.' + clause[0],) + tuple(clause[1:])]
 
     @classmethod
     def __setup__(cls):
@@ -648,20 +1378,26 @@ class WebsiteStoreView(ModelSQL, ModelView):
         :param values: Dictionary of values for store view sent by magento
         :return: Actice record of record created/found
         """
-        store_views = cls.search([
-            ('store', '=', store.id),
-            ('magento_id', '=', int(values['store_id']))
-        ])
+        return cls.find_or_create_all(('store', 'magento_id'), [
+            cls.get_values_using_magento_data(store, values)
+        ])[0]
 
-        if store_views:
-            return store_views[0]
+    @staticmethod
+    def get_values_using_magento_data(store, values):
+        """
+        Returns the values of the store view whose `values` are sent by
+        magento for the store with `store` in tryton
 
-        return cls(**{
+        :param store: Active record of store
+        :param values: Dictionary of values for store view sent by magento
+        :return: Dictionary of values of store view
+        """
+        return {
             'name': values['name'],
             'code': values['code'],
             'store': store.id,
             'magento_id': int(values['store_id']),
-        })
+        }
 
     @classmethod
     @ModelView.button_action('magento.wizard_import_orders')
@@ -742,43 +1478,46 @@ class WebsiteStoreView(ModelSQL, ModelView):
 
         return new_sales
 
-    def export_order_status(self, store_views=None):
+    @classmethod
+    def export_order_status(cls, store_views=None):
         """
-        Export sales orders status to magento.
+        Export sales orders status to magento. The pending state changes of
+        all the store views of an instance are exported together.
 
         :param store_views: List of active record of store view
+        :return: List of active records of sales exported
         """
+        StateChange = Pool().get('magento.sale.state_change')
+
         if store_views is None:
-            store_views = self.search([])
+            store_views = cls.search([])
 
-        for store_view in store_views:
-            store_view.export_order_status_for_store_view()
+        if not store_views:
+            return []
+
+        state_changes = StateChange.search([
+            ('store_view', 'in', map(int, store_views)),
+            ('exported', '=', False),
+        ], order=[('id', 'ASC')])
+
+        cls.write(store_views, {
+            'last_order_export_time': datetime.utcnow()
+        })
+
+        return [
+            state_change.sale
+            for state_change in StateChange.export_to_magento(state_changes)
+        ]
 
     def export_order_status_for_store_view(self):
         """
         Export sale orders to magento for the current store view.
-        If last export time is defined, export only those orders which are
-        updated after last export time.
+        Only the state changes of sales of this store view which are not yet
+        exported are sent to magento.
 
         :return: List of active records of sales exported
         """
-        Sale = Pool().get('sale.sale')
-
-        exported_sales = []
-        domain = [('magento_store_view', '=', self.id)]
-
-        if self.last_order_export_time:
-            domain = [('write_date', '>=', self.last_order_export_time)]
-
-        sales = Sale.search(domain)
-
-        self.last_order_export_time = datetime.utcnow()
-        self.save()
-
-        for sale in sales:
-            exported_sales.append(sale.export_order_status_to_magento())
-
-        return exported_sales
+        return self.export_order_status([self])
 
     @classmethod
     def import_orders(cls, store_views=None):
@@ -840,11 +1579,6 @@ class WebsiteStoreView(ModelSQL, ModelView):
         self.save()
 
         for sale in sales:
-            # Get the increment id from the sale reference
-            increment_id = sale.reference[
-                len(instance.order_prefix): len(sale.reference)
-            ]
-
             for shipment in sale.shipments:
                 try:
                     # Some checks to make sure that only valid shipments are
@@ -870,7 +1604,7 @@ class WebsiteStoreView(ModelSQL, ModelView):
                                 item_qty_map[str(move.origin.magento_id)] += \
                                     move.quantity
                         shipment_increment_id = shipment_api.create(
-                            order_increment_id=increment_id,
+                            order_increment_id=sale.magento_increment_id,
                             items_qty=item_qty_map
                         )
                         Shipment.write(list(sale.shipments), {
@@ -928,6 +1662,52 @@ class StorePriceTier(ModelSQL, ModelView):
         ]
 
 
+class StoreTierPriceFingerprint(ModelSQL):
+    """Tier price fingerprint for store
+
+    This model stores a fingerprint of the tier prices last exported to
+    magento for a product from a store. It is used to export only the
+    products whose tier prices changed since.
+    """
+    __name__ = 'magento.store.tier_price_fingerprint'
+
+    store = fields.Many2One(
+        'magento.website.store', 'Magento Store', required=True,
+        select=True, ondelete='CASCADE',
+    )
+    magento_product_template = fields.Many2One(
+        'magento.website.template', 'Magento Product Template',
+        required=True, select=True, ondelete='CASCADE',
+    )
+    fingerprint = fields.Char('Fingerprint', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        """
+        Setup the class before adding to pool
+        """
+        super(StoreTierPriceFingerprint, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'store_template_unique',
+                'UNIQUE(store, magento_product_template)',
+                'Tier price fingerprint must be unique for a product in a '
+                'store'
+            )
+        ]
+
+    @staticmethod
+    def get_fingerprint(price_data):
+        """
+        Returns the fingerprint of the tier prices sent to magento
+
+        :param price_data: List of dictionaries of quantity and price
+        """
+        return hashlib.sha1(
+            json.dumps(price_data, sort_keys=True)
+        ).hexdigest()
+
+
 class TestConnectionStart(ModelView):
     "Test Connection"
     __name__ = 'magento.wizard_test_connection.start'
@@ -1104,12 +1884,23 @@ class ExportTierPricesStart(ModelView):
     "Export Tier Prices Start View"
     __name__ = 'magento.wizard_export_tier_prices.start'
 
+    force = fields.Boolean(
+        'Export All', help='Export tier prices of all the products, even of '
+        'those whose tier prices did not change since they were last exported'
+    )
+
+    @staticmethod
+    def default_force():
+        return False
+
 
 class ExportTierPricesStatus(ModelView):
     "Export Tier Prices Status View"
     __name__ = 'magento.wizard_export_tier_prices.status'
 
     products_count = fields.Integer('Products Count', readonly=True)
+    failures_count = fields.Integer('Failures Count', readonly=True)
+    failures = fields.Text('Failures', readonly=True)
 
 
 class ExportTierPrices(Wizard):
@@ -1138,13 +1929,24 @@ class ExportTierPrices(Wizard):
     )
 
     def default_export_(self, fields):
-        """Export price tiers and return count of products"""
+        """Export price tiers and return count of products and failures"""
         Store = Pool().get('magento.website.store')
 
         store = Store(Transaction().context.get('active_id'))
 
+        products_count, failures = store.export_tier_prices_to_magento(
+            force=self.start.force
+        )
+
         return {
-            'products_count': store.export_tier_prices_to_magento()
+            'products_count': products_count,
+            'failures_count': len(failures),
+            'failures': '\n'.join([
+                '%s (Magento ID %s): %s' % (
+                    mag_product_template.template.rec_name,
+                    mag_product_template.magento_id, message
+                ) for mag_product_template, message in failures
+            ]),
         }
 
 
@@ -1225,3 +2027,58 @@ class MagentoException(ModelSQL, ModelView):
             ('sale.sale', 'Sale'),
             ('sale.line', 'Sale Line'),
         ]
+
+    @classmethod
+    def get_origin_sales(cls, exceptions):
+        """
+        Returns the sales which are the origin of the exceptions
+
+        :param exceptions: List of active records of exceptions
+        :return: List of active records of sales
+        """
+        Sale = Pool().get('sale.sale')
+
+        return Sale.browse(list(set(
+            exception.origin.id for exception in exceptions
+            if isinstance(exception.origin, Sale) and
+            exception.origin.id >= 0
+        )))
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Flag the sales for which exceptions are created
+        """
+        Sale = Pool().get('sale.sale')
+
+        exceptions = super(MagentoException, cls).create(vlist)
+        Sale.update_magento_exception_flag(cls.get_origin_sales(exceptions))
+        return exceptions
+
+    @classmethod
+    def write(cls, *args):
+        """
+        Update the flag of the sales which were or are now the origin of the
+        exceptions
+        """
+        Sale = Pool().get('sale.sale')
+
+        exceptions = [
+            exception for records in args[::2] for exception in records
+        ]
+        sales = cls.get_origin_sales(exceptions)
+        super(MagentoException, cls).write(*args)
+        Sale.update_magento_exception_flag(list(set(
+            sales + cls.get_origin_sales(cls.browse(map(int, exceptions)))
+        )))
+
+    @classmethod
+    def delete(cls, exceptions):
+        """
+        Clear the flag of the sales left without any exception
+        """
+        Sale = Pool().get('sale.sale')
+
+        sales = cls.get_origin_sales(exceptions)
+        super(MagentoException, cls).delete(exceptions)
+        Sale.update_magento_exception_flag(sales)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    mixin
+
+    Mixins shared by the models mapping tryton records to magento records
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.model import Model
+from trytond.transaction import Transaction
+
+
+__all__ = ['FindOrCreateMixin']
+
+#: SQLSTATE of the violation of a unique constraint
+UNIQUE_VIOLATION = '23505'
+
+
+def _key_value(value):
+    """
+    Returns the value used in a key for a field value, which is the ID for
+    a relational value
+    """
+    if isinstance(value, Model):
+        return value.id
+    return value
+
+
+@contextmanager
+def savepoint(name):
+    """
+    Runs the block in a database savepoint, which is rolled back if the
+    block fails. SQLite runs the block without savepoint, as the driver
+    commits the transaction before a savepoint statement.
+
+    :param name: Name of the savepoint
+    """
+    if backend.name() == 'sqlite':
+        yield
+        return
+
+    cursor = Transaction().cursor
+    cursor.execute('SAVEPOINT %s' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT %s' % name)
+        raise
+    cursor.execute('RELEASE SAVEPOINT %s' % name)
+
+
+class FindOrCreateMixin(object):
+    """
+    Finds and creates the records of a mapping model in bulk, identifying the
+    records by a natural key like (instance, code) or (website, magento_id)
+    """
+
+    @classmethod
+    def find_all_by_key(cls, key_fields, keys):
+        """
+        Finds the records matching the keys in a single search
+
+        :param key_fields: Tuple of the names of the fields of the key
+        :param keys: List of tuples of values of the key fields
+        :return: Dictionary of active records with the key as key
+        """
+        keys = set(
+            tuple(_key_value(value) for value in key) for key in keys
+        )
+        if not keys:
+            return {}
+
+        # Search the records matching any of the values of each field, and
+        # keep only those matching a key
+        domain = [
+            (name, 'in', list(set(key[index] for key in keys)))
+            for index, name in enumerate(key_fields)
+        ]
+        records = {}
+        for record in cls.search(domain):
+            key = tuple(
+                _key_value(getattr(record, name)) for name in key_fields
+            )
+            if key in keys:
+                records[key] = record
+        return records
+
+    @classmethod
+    def find_or_create_all(cls, key_fields, values_list):
+        """
+        Finds the records matching the values on the key fields, and creates
+        those which do not exist in a single create, using the records
+        created meanwhile by a concurrent transaction if any
+
+        :param key_fields: Tuple of the names of the fields of the key
+        :param values_list: List of dictionaries of values of the records
+        :return: List of active records in the same order as `values_list`
+        """
+        keys = [
+            tuple(_key_value(values[name]) for name in key_fields)
+            for values in values_list
+        ]
+        records = cls.find_all_by_key(key_fields, keys)
+
+        new_keys, to_create = [], []
+        to_create_keys = set()
+        for key, values in zip(keys, values_list):
+            if key in records or key in to_create_keys:
+                continue
+            to_create_keys.add(key)
+            new_keys.append(key)
+            to_create.append(values)
+        if to_create:
+            records.update(zip(new_keys, cls.create_or_get(
+                key_fields, new_keys, lambda: cls.create(to_create)
+            )))
+
+        return [records[key] for key in keys]
+
+    @classmethod
+    def create_or_get(cls, key_fields, keys, create):
+        """
+        Creates the records of the keys with `create` and returns them. The
+        records can be created directly or through their parent, like a
+        product template created with its magento links.
+
+        When a concurrent import created records with the same keys
+        meanwhile, the creation fails on the unique constraint of the model.
+        It is then rolled back to a savepoint and the records are searched
+        again, which finds them when the concurrent transaction committed
+        before this one read the table. Under the repeatable read isolation
+        used by tryton on PostgreSQL, the records committed later are never
+        visible to this transaction, so a database operational error is
+        raised instead: the dispatcher retries the request, which then finds
+        the records.
+
+        :param key_fields: Tuple of the names of the fields of the key
+        :param keys: List of tuples of values of the key fields of the
+                     records created
+        :param create: Function without argument creating the records
+        :return: List of active records in the same order as `keys`
+        """
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        keys = [tuple(_key_value(value) for value in key) for key in keys]
+        try:
+            with Transaction().set_context(
+                _magento_create_or_get=cls.__name__
+            ), savepoint('magento_create_or_get'):
+                create()
+        except DatabaseIntegrityError, exception:
+            if not cls.is_unique_conflict(exception):
+                raise
+            records = cls.find_all_by_key(key_fields, keys)
+            if len(records) < len(set(keys)):
+                raise DatabaseOperationalError(
+                    'Concurrent creation of %s' % cls.__name__
+                )
+        else:
+            records = cls.find_all_by_key(key_fields, keys)
+        return [records[key] for key in keys]
+
+    @classmethod
+    def is_unique_conflict(cls, exception):
+        """
+        Returns True if the exception is the violation of a unique constraint
+        of the model. The constraint is identified by its name, which the
+        database reports in the error, and by the SQLSTATE of the error on
+        the backends which report it.
+
+        :param exception: Database integrity error raised on creation
+        """
+        if getattr(exception, 'pgcode', UNIQUE_VIOLATION) != \
+                UNIQUE_VIOLATION:
+            return False
+        message = exception.args[0] if exception.args else ''
+        return any(
+            '%s_%s' % (cls._table, name) in message
+            for name, definition, _ in cls._sql_constraints
+            if definition.strip().upper().startswith('UNIQUE')
+        )
+
+    @classmethod
+    def _ModelSQL__raise_integrity_error(
+        cls, exception, values, field_names=None
+    ):
+        """
+        The ORM turns the violation of a constraint into a user error with
+        the translated message of the constraint. The violation of a unique
+        constraint by the records created in :meth:`create_or_get` is kept
+        as the database error instead, so that the conflict is detected
+        from the error itself.
+        """
+        if Transaction().context.get('_magento_create_or_get') == \
+                cls.__name__ and cls.is_unique_conflict(exception):
+            return
+        super(FindOrCreateMixin, cls)._ModelSQL__raise_integrity_error(
+            exception, values, field_names
+        )
@@ -9,9 +9,15 @@
 """
 import magento
 
+from sql import Null
+from sql.aggregate import Count
+from sql.functions import Lower, Trim
+
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 
 
 __all__ = ['Party', 'MagentoWebsiteParty', 'Address']
@@ -109,6 +115,8 @@ class Party:
         :param magento_data: Dictionary of values for customer sent by magento
         :return: Active record of record created
         """
+        MagentoParty = Pool().get('magento.website.party')
+
         party, = cls.create([{
             'name': u' '.join(
                 [magento_data['firstname'], magento_data['lastname']]
@@ -117,6 +125,9 @@ class Party:
                 ('create', [{
                     'magento_id': magento_data['customer_id'],
                     'website': Transaction().context['magento_website'],
+                    'email': MagentoParty.normalize_email(
+                        magento_data['email']
+                    ),
                 }])
             ],
             'contact_mechanisms': [
@@ -151,6 +162,31 @@ class Party:
         else:
             return magento_party.party
 
+    @classmethod
+    def find_guest_using_magento_email(cls, email):
+        """
+        Looks for the party of an earlier guest customer with the email in
+        the magento_website in context. The email is compared once
+        normalized.
+
+        :param email: Email of the guest customer sent by magento
+        :return: Active record of the party found or None
+        """
+        MagentoParty = Pool().get('magento.website.party')
+
+        email = MagentoParty.normalize_email(email)
+        if not email:
+            return None
+
+        magento_parties = MagentoParty.search([
+            ('website', '=', Transaction().context['magento_website']),
+            ('email', '=', email),
+            ('magento_id', '=', 0),
+        ], order=[('id', 'ASC')], limit=1)
+        if not magento_parties:
+            return None
+        return magento_parties[0].party
+
 
 class MagentoWebsiteParty(ModelSQL, ModelView):
     "Magento Website Party"
@@ -163,6 +199,8 @@ class MagentoWebsiteParty(ModelSQL, ModelView):
     party = fields.Many2One(
         'party.party', 'Party', required=True, readonly=True
     )
+    #: Email of the customer, stripped and in lower case
+    email = fields.Char('Email', readonly=True)
 
     @classmethod
     def validate(cls, records):
@@ -179,20 +217,99 @@ class MagentoWebsiteParty(ModelSQL, ModelView):
             'party_exists': 'A party must be unique in a website'
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        """
+        Register the class and add the indexes used to find the party of a
+        magento customer, and of a guest customer by email
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        # Migration: The email of the guest customers was not stored
+        email_exist = (
+            TableHandler.table_exist(cursor, cls._table) and
+            TableHandler(cursor, cls, module_name).column_exist('email')
+        )
+
+        super(MagentoWebsiteParty, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['website', 'magento_id'], 'add')
+        table.index_action(['website', 'email'], 'add')
+
+        if not email_exist:
+            cls.fill_guest_emails()
+
+    @classmethod
+    def fill_guest_emails(cls):
+        """
+        Fill the email of the guest customers without one from the first
+        email of their party
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+        cursor = Transaction().cursor
+        magento_party = cls.__table__()
+        contact_mechanism = ContactMechanism.__table__()
+
+        cursor.execute(*magento_party.update(
+            columns=[magento_party.email],
+            values=[contact_mechanism.select(
+                Lower(Trim(contact_mechanism.value)),
+                where=(
+                    (contact_mechanism.party == magento_party.party) &
+                    (contact_mechanism.type == 'email')
+                ),
+                order_by=[contact_mechanism.id.asc],
+                limit=1
+            )],
+            where=(
+                (magento_party.email == Null) &
+                (magento_party.magento_id == 0)
+            )
+        ))
+
+    @staticmethod
+    def normalize_email(email):
+        """
+        Returns the email stripped and in lower case, as stored on the links
+
+        :param email: Email sent by magento
+        :return: Normalized email or None
+        """
+        if not email:
+            return None
+        return email.strip().lower() or None
+
     @classmethod
     def check_unique_party(cls, records):
         """Checks thats each party should be unique in a website if it
         does not have a magento ID of 0. magento_id of 0 means its a guest
         customer.
 
+        The duplicates of a batch of records are found with a single
+        grouped query.
+
         :param records: List of active records
         """
-        for magento_partner in records:
-            if magento_partner.magento_id != 0 and cls.search([
-                ('magento_id', '=', magento_partner.magento_id),
-                ('website', '=', magento_partner.website.id),
-                ('id', '!=', magento_partner.id),
-            ], count=True) > 0:
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        for sub_records in grouped_slice(records):
+            keys = set(
+                (record.website.id, record.magento_id)
+                for record in sub_records if record.magento_id != 0
+            )
+            if not keys:
+                continue
+            cursor.execute(*table.select(
+                table.website, table.magento_id,
+                where=table.website.in_(list(set(k[0] for k in keys))) &
+                    table.magento_id.in_(list(set(k[1] for k in keys))),
+                group_by=[table.website, table.magento_id],
+                having=Count(table.id) > 1
+            ))
+            if any(key in keys for key in cursor.fetchall()):
                 cls.raise_user_error('party_exists')
 
 
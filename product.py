@@ -6,23 +6,51 @@
     :license: BSD, see LICENSE for more details.
 '''
 import magento
-from trytond.model import ModelSQL, ModelView, fields
+from trytond import backend
+from trytond.model import Model, ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.pyson import PYSONEncoder
 from trytond.pool import PoolMeta, Pool
 from decimal import Decimal
 
+from .api import multicall_in_chunks, is_fault, fetch_products_info
+from .mixin import FindOrCreateMixin
+
 
 __all__ = [
     'Category', 'MagentoInstanceCategory', 'Template',
     'MagentoWebsiteTemplate', 'ProductPriceTier', 'UpdateCatalogStart',
-    'UpdateCatalog', 'ImportCatalogStart', 'ImportCatalog',
-    'ExportCatalogStart', 'ExportCatalog'
+    'UpdateCatalog', 'ImportCatalogStart', 'ImportCatalogStatus',
+    'ImportCatalog',
+    'ExportCatalogStart', 'ExportCatalogStatus', 'ExportCatalog'
 ]
 __metaclass__ = PoolMeta
 
 
+def get_changed_values(record, values):
+    """
+    Returns the values which differ from the ones of the record. Relational
+    values are compared by ID and values which are not plain field values,
+    like lists of x2many operations, are always taken as changed.
+
+    :param record: Active record
+    :param values: Dictionary of values to be written on the record
+    :returns: Dictionary of the changed values
+    """
+    changed = {}
+    for name, value in values.iteritems():
+        if isinstance(value, (list, tuple)):
+            changed[name] = value
+            continue
+        current = getattr(record, name)
+        if isinstance(current, Model):
+            current = current.id
+        if current != value:
+            changed[name] = value
+    return changed
+
+
 class Category:
     "Product Category"
     __name__ = "product.category"
@@ -35,20 +63,91 @@ class Category:
     @classmethod
     def create_tree_using_magento_data(cls, category_tree):
         """
-        Create the categories from the category tree
+        Create the categories from the category tree. The tree is walked
+        once, level by level, and the missing categories of a level are
+        created together under their parents of the level above.
 
         :param category_tree: Category Tree from Magento
+        :returns: Dictionary of category IDs with magento ID as key, for all
+                  the categories of the instance
+        """
+        MagentoCategory = Pool().get('magento.instance.product_category')
+
+        instance_id = Transaction().context.get('magento_instance')
+        category_map = cls.get_magento_category_map()
+
+        # Each level is a list of tuples of the node and the magento ID of
+        # its parent in the tree
+        level = [(category_tree, None)]
+        while level:
+            nodes_to_create = [
+                (node, parent_id) for node, parent_id in level
+                if int(node['category_id']) not in category_map
+            ]
+            magento_categories = MagentoCategory.create_or_get(
+                ('magento_id', 'instance'), [
+                    (int(node['category_id']), instance_id)
+                    for node, _ in nodes_to_create
+                ], lambda: cls.create([{
+                    'name': node['name'],
+                    'parent': category_map.get(parent_id),
+                    'magento_ids': [('create', [{
+                        'magento_id': int(node['category_id']),
+                        'instance': instance_id,
+                    }])],
+                } for node, parent_id in nodes_to_create])
+            ) if nodes_to_create else []
+            for magento_category in magento_categories:
+                category_map[magento_category.magento_id] = \
+                    magento_category.category.id
+
+            level = [
+                (child, int(node['category_id']))
+                for node, _ in level for child in node['children']
+            ]
+
+        return category_map
+
+    @classmethod
+    def get_magento_category_map(cls):
         """
-        # Create the root
-        root_category = cls.find_or_create_using_magento_data(
-            category_tree
+        Returns the categories of the current magento instance
+
+        :returns: Dictionary of category IDs with magento ID as key
+        """
+        MagentoCategory = Pool().get('magento.instance.product_category')
+
+        return dict(
+            (record['magento_id'], record['category'])
+            for record in MagentoCategory.search_read([
+                ('instance', '=', Transaction().context.get('magento_instance'))
+            ], fields_names=['magento_id', 'category'])
         )
-        for child in category_tree['children']:
-            cls.find_or_create_using_magento_data(
-                child, parent=root_category
-            )
-            if child['children']:
-                cls.create_tree_using_magento_data(child)
+
+    @classmethod
+    def get_magento_category_map_for(cls, magento_ids):
+        """
+        Returns the categories of the current magento instance, making sure
+        that the categories with the given magento IDs are in it. If any of
+        them is not known yet, the whole category tree is fetched from
+        magento in one call and imported.
+
+        :param magento_ids: List of category IDs from magento
+        :returns: Dictionary of category IDs with magento ID as key
+        """
+        Instance = Pool().get('magento.instance')
+
+        category_map = cls.get_magento_category_map()
+        if set(magento_ids) <= set(category_map):
+            return category_map
+
+        instance = Instance(Transaction().context.get('magento_instance'))
+        with magento.Category(
+            instance.url, instance.api_user, instance.api_key
+        ) as category_api:
+            category_tree = category_api.tree()
+
+        return cls.create_tree_using_magento_data(category_tree)
 
     @classmethod
     def find_or_create_using_magento_data(
@@ -144,19 +243,29 @@ class Category:
         :param parent: Browse record of Parent if present, else None
         :returns: Active record of category created
         """
-        category, = cls.create([{
-            'name': category_data['name'],
-            'parent': parent,
-            'magento_ids': [('create', [{
-                'magento_id': int(category_data['category_id']),
-                'instance': Transaction().context.get('magento_instance'),
-            }])],
-        }])
+        MagentoCategory = Pool().get('magento.instance.product_category')
 
-        return category
+        instance_id = Transaction().context.get('magento_instance')
+
+        # If a concurrent import created the same category meanwhile, that
+        # one is used instead
+        magento_category, = MagentoCategory.create_or_get(
+            ('magento_id', 'instance'), [
+                (int(category_data['category_id']), instance_id)
+            ], lambda: cls.create([{
+                'name': category_data['name'],
+                'parent': parent,
+                'magento_ids': [('create', [{
+                    'magento_id': int(category_data['category_id']),
+                    'instance': instance_id,
+                }])],
+            }])
+        )
 
+        return magento_category.category
 
-class MagentoInstanceCategory(ModelSQL, ModelView):
+
+class MagentoInstanceCategory(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Instance - Product Category Store
 
@@ -191,6 +300,20 @@ class MagentoInstanceCategory(ModelSQL, ModelView):
             )
         ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        """
+        Register the class and add the index used to find the category of
+        a magento category
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(MagentoInstanceCategory, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['instance', 'magento_id'], 'add')
+
 
 class Template:
     "Product Template"
@@ -226,16 +349,20 @@ class Template:
             "invalid_product": 'Product "%s" already has a magento product '
                 'associated',
             "missing_product_code": 'Product "%s" has a missing code.',
+            "product_export_failed": 'Product "%s" could not be created on '
+                'magento: %s',
         })
 
     @classmethod
-    def find_or_create_using_magento_id(cls, magento_id):
+    def find_or_create_using_magento_id(cls, magento_id, category_map=None):
         """
         Find or create a product template using magento ID. This method looks
         for an existing template using the magento ID provided. If found, it
         returns the template found, else creates a new one and returns that
 
         :param magento_id: Product ID from Magento
+        :param category_map: Dictionary of category IDs with magento ID as
+                             key, see :meth:`create_using_magento_data`
         :returns: Active record of Product Created
         """
         Website = Pool().get('magento.instance.website')
@@ -253,7 +380,9 @@ class Template:
             ) as product_api:
                 product_data = product_api.info(magento_id)
 
-            product_template = cls.create_using_magento_data(product_data)
+            product_template = cls.create_using_magento_data(
+                product_data, category_map
+            )
 
         return product_template
 
@@ -340,7 +469,7 @@ class Template:
         }
 
     @classmethod
-    def create_using_magento_data(cls, product_data):
+    def create_using_magento_data(cls, product_data, category_map=None):
         """
         Create a new product with the `product_data` from magento.This method
         also looks for the category of the product. If found, it uses that
@@ -348,18 +477,30 @@ class Template:
         the product to `Unclassified Magento Product` category
 
         :param product_data: Product Data from Magento
+        :param category_map: Dictionary of category IDs with magento ID as
+                             key. If given, the category is looked up only in
+                             it, else it is searched and fetched from magento
+                             if not found.
         :returns: Browse record of product created
         """
         Category = Pool().get('product.category')
+        MagentoProductTemplate = Pool().get('magento.website.template')
+
+        website_id = Transaction().context.get('magento_website')
 
         # Get only the first category from the list of categories
         # If no category is found, put product under unclassified category
         # which is created by default data
+        category = None
         if product_data.get('categories'):
-            category = Category.find_or_create_using_magento_id(
-                int(product_data['categories'][0])
-            )
-        else:
+            magento_category_id = int(product_data['categories'][0])
+            if category_map is None:
+                category = Category.find_or_create_using_magento_id(
+                    magento_category_id
+                )
+            elif magento_category_id in category_map:
+                category = Category(category_map[magento_category_id])
+        if category is None:
             categories = Category.search([
                 ('name', '=', 'Unclassified Magento Products')
             ])
@@ -377,13 +518,19 @@ class Template:
             'magento_product_type': product_data['type'],
             'magento_ids': [('create', [{
                 'magento_id': int(product_data['product_id']),
-                'website': Transaction().context.get('magento_website'),
+                'website': website_id,
             }])],
         })
 
-        product_template, = cls.create([product_template_values])
+        # If a concurrent import created the same product meanwhile, that
+        # one is used instead
+        magento_product_template, = MagentoProductTemplate.create_or_get(
+            ('magento_id', 'website'), [
+                (int(product_data['product_id']), website_id)
+            ], lambda: cls.create([product_template_values])
+        )
 
-        return product_template
+        return magento_product_template.template
 
     def update_from_magento(self):
         """
@@ -417,19 +564,56 @@ class Template:
         :param product_data: Product Data from magento
         :returns: Active record of product updated
         """
-        product_template_values = self.extract_product_values_from_data(
-            product_data
-        )
-        product_template_values.update({
-            'products': [('write', map(int, self.products), {
-                'description': product_data['description'],
-                'code': product_data['sku'],
-            })]
-        })
-        self.write([self], product_template_values)
+        self.update_all_from_magento_using_data([(self, product_data)])
 
         return self
 
+    @classmethod
+    def update_all_from_magento_using_data(cls, templates_data):
+        """
+        Update products using magento data. Only the fields whose value
+        changed are written, and the records getting the same values are
+        written together, so that the products which did not change are not
+        written at all.
+
+        :param templates_data: List of tuples of active record of product
+                               template and product data from magento
+        """
+        Product = Pool().get('product.product')
+
+        template_groups = {}
+        product_groups = {}
+        for template, product_data in templates_data:
+            values = get_changed_values(
+                template, cls.extract_product_values_from_data(product_data)
+            )
+            if values:
+                template_groups.setdefault(
+                    repr(sorted(values.items())), (values, [])
+                )[1].append(template)
+
+            for product in template.products:
+                values = get_changed_values(product, {
+                    'description': product_data['description'],
+                    'code': product_data['sku'],
+                })
+                if values:
+                    product_groups.setdefault(
+                        repr(sorted(values.items())), (values, [])
+                    )[1].append(product)
+
+        to_write = []
+        for values, templates in template_groups.itervalues():
+            to_write.extend([templates, values])
+        if to_write:
+            cls.write(*to_write)
+
+        to_write = []
+        for values, products in product_groups.itervalues():
+            to_write.extend([products, values])
+        if to_write:
+            Product.write(*to_write)
+
     def get_product_values_for_export_to_magento(self, categories, websites):
         """Creates a dictionary of values which have to exported to magento for
         creating a product
@@ -460,9 +644,22 @@ class Template:
                          to be exported
         :return: Active record of product
         """
-        Website = Pool().get('magento.instance.website')
-        WebsiteProductTemplate = Pool().get('magento.website.template')
+        failures = self.export_all_to_magento([self], category)[1]
+        if failures:
+            (_, message), = failures
+            self.raise_user_error(
+                'product_export_failed', (self.name, message)
+            )
+        return self
+
+    def check_export_to_magento(self, category):
+        """
+        Checks that the current product can be exported to the magento
+        category corresponding to the given `category`
 
+        :param category: Active record of category to which the product has
+                         to be exported
+        """
         if not category.magento_ids:
             self.raise_user_error(
                 'invalid_category', (category.complete_name,)
@@ -478,40 +675,77 @@ class Template:
                 'missing_product_code', (self.name,)
             )
 
+    @classmethod
+    def export_all_to_magento(cls, templates, category, chunk_size=100):
+        """
+        Export the products to the magento category corresponding to the
+        given `category` under the current website in context. All the
+        products are checked before any of them is exported, and they are
+        then created on magento in multiCalls of `chunk_size` products each,
+        all in a single session.
+
+        :param templates: List of active records of products
+        :param category: Active record of category to which the products
+                         have to be exported
+        :param chunk_size: Number of products created in one multiCall
+        :return: Tuple of the list of active records of products exported and
+                 a list of tuples of product and fault message for the
+                 products which magento failed to create
+        """
+        Website = Pool().get('magento.instance.website')
+        WebsiteProductTemplate = Pool().get('magento.website.template')
+
+        if not templates:
+            return [], []
+
+        for template in templates:
+            template.check_export_to_magento(category)
+
         website = Website(Transaction().context['magento_website'])
         instance = website.instance
-
+        attribute_set = int(Transaction().context['magento_attribute_set'])
+
+        # We create only simple products on magento with the default
+        # attribute set
+        # TODO: We have to call the method from core API extension
+        # because the method for catalog create from core API does not seem
+        # to work. This should ideally be from core API rather than
+        # extension
+        calls = [
+            ['ol_catalog_product.create', [
+                'simple', attribute_set, template.products[0].code,
+                template.get_product_values_for_export_to_magento(
+                    [category], [website]
+                )
+            ]] for template in templates
+        ]
         with magento.Product(
             instance.url, instance.api_user, instance.api_key
         ) as product_api:
-            # We create only simple products on magento with the default
-            # attribute set
-            # TODO: We have to call the method from core API extension
-            # because the method for catalog create from core API does not seem
-            # to work. This should ideally be from core API rather than
-            # extension
-            magento_id = product_api.call(
-                'ol_catalog_product.create', [
-                    'simple',
-                    int(Transaction().context['magento_attribute_set']),
-                    self.products[0].code,
-                    self.get_product_values_for_export_to_magento(
-                        [category], [website]
-                    )
-                ]
-            )
+            results = multicall_in_chunks(product_api, calls, chunk_size)
+
+        exported = []
+        failures = []
+        for template, result in zip(templates, results):
+            if is_fault(result):
+                failures.append((template, result.get('faultMessage')))
+            else:
+                exported.append((template, result))
+
+        if exported:
             WebsiteProductTemplate.create([{
-                'magento_id': magento_id,
+                'magento_id': int(magento_id),
                 'website': website.id,
-                'template': self.id,
-            }])
-            self.write([self], {
+                'template': template.id,
+            } for template, magento_id in exported])
+            cls.write([template for template, _ in exported], {
                 'magento_product_type': 'simple'
             })
-        return self
+
+        return [template for template, _ in exported], failures
 
 
-class MagentoWebsiteTemplate(ModelSQL, ModelView):
+class MagentoWebsiteTemplate(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento Website ---  Product Template Store
 
@@ -532,6 +766,21 @@ class MagentoWebsiteTemplate(ModelSQL, ModelView):
         required=True, select=True
     )
 
+    #: Checked when the stock of the product changed since its stock was
+    #: last exported to magento
+    stock_dirty = fields.Boolean('Stock Changed', readonly=True, select=True)
+
+    #: The stock status of the product last exported to magento
+    magento_is_in_stock = fields.Boolean('In Stock On Magento', readonly=True)
+
+    @staticmethod
+    def default_stock_dirty():
+        return False
+
+    @staticmethod
+    def default_magento_is_in_stock():
+        return False
+
     @classmethod
     def __setup__(cls):
         '''
@@ -550,6 +799,35 @@ class MagentoWebsiteTemplate(ModelSQL, ModelView):
             'update_product_from_magento': {},
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        """
+        Register the class and add the index used to find the product of a
+        magento product
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(MagentoWebsiteTemplate, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['website', 'magento_id'], 'add')
+
+    @classmethod
+    def mark_stock_dirty(cls, templates):
+        """
+        Marks the stock of the templates as changed on all the websites they
+        are exported to
+
+        :param templates: List of active records or IDs of product templates
+        """
+        records = cls.search([
+            ('template', 'in', map(int, templates)),
+            ('stock_dirty', '=', False),
+        ])
+        if records:
+            cls.write(records, {'stock_dirty': True})
+
     @classmethod
     def update_product_from_magento(cls, magento_product_templates):
         """
@@ -559,13 +837,49 @@ class MagentoWebsiteTemplate(ModelSQL, ModelView):
         :param magento_product_templates: List of active record of magento
                                           product templates
         """
-        for magento_product_template in magento_product_templates:
-            with Transaction().set_context({
-                    'magento_website': magento_product_template.website.id}):
-                magento_product_template.template.update_from_magento()
+        cls.update_templates_from_magento(magento_product_templates)
 
         return {}
 
+    @classmethod
+    def update_templates_from_magento(
+        cls, magento_product_templates, workers=4
+    ):
+        """
+        Update the products from magento with the details from magento for
+        the website of each magento product template. The details are
+        fetched with several sessions in parallel, and the products are then
+        updated in order.
+
+        :param magento_product_templates: List of active record of magento
+                                          product templates
+        :param workers: Maximum number of magento sessions opened in parallel
+        :return: List of active records of product templates updated
+        """
+        Template = Pool().get('product.template')
+
+        records_by_website = {}
+        for magento_product_template in magento_product_templates:
+            records_by_website.setdefault(
+                magento_product_template.website, []
+            ).append(magento_product_template)
+
+        for website, records in records_by_website.iteritems():
+            products_data = fetch_products_info(
+                website.instance, [record.magento_id for record in records],
+                workers
+            )
+            with Transaction().set_context({'magento_website': website.id}):
+                Template.update_all_from_magento_using_data([
+                    (record.template, products_data[record.magento_id])
+                    for record in records
+                ])
+
+        return [
+            magento_product_template.template
+            for magento_product_template in magento_product_templates
+        ]
+
 
 class ProductPriceTier(ModelSQL, ModelView):
     """Price Tiers for product
@@ -576,21 +890,35 @@ class ProductPriceTier(ModelSQL, ModelView):
     __name__ = 'product.price_tier'
     _rec_name = 'quantity'
 
-    def get_price(self, name):
-        """Calculate the price of the product for quantity set in record
+    @classmethod
+    def get_price(cls, tiers, name):
+        """Calculate the price of the product for quantity set in records
 
+        :param tiers: List of active records of price tiers
         :param name: Name of field
         """
         Store = Pool().get('magento.website.store')
 
         if not Transaction().context.get('magento_store'):
-            return 0
+            return dict((tier.id, 0) for tier in tiers)
 
         store = Store(Transaction().context['magento_store'])
-        return store.price_list.compute(
-            None, self.template, self.template.list_price, self.quantity,
-            store.website.default_uom
+
+        # A template without product has no price
+        product_tiers = [
+            (tier, tier.template.products[0]) for tier in tiers
+            if tier.template.products
+        ]
+        prices = Store.compute_price_matrix(store.price_list, [
+            (product, tier.quantity) for tier, product in product_tiers
+        ], store.website.default_uom)
+
+        res = dict((tier.id, 0) for tier in tiers)
+        res.update(
+            (tier.id, prices[(product.id, tier.quantity)])
+            for tier, product in product_tiers
         )
+        return res
 
     template = fields.Many2One(
         'product.template', 'Product Template', required=True, readonly=True,
@@ -661,14 +989,17 @@ class UpdateCatalog(Wizard):
         :param website: Browse record of website
         :return: List of product templates IDs
         """
-        product_templates = []
-        with Transaction().set_context({'magento_website': website.id}):
-            for mag_product_template in website.magento_product_templates:
-                product_templates.append(
-                    mag_product_template.template.update_from_magento()
+        MagentoProductTemplate = Pool().get('magento.website.template')
+
+        product_template_ids = []
+        for mag_product_templates in website.iter_magento_product_templates():
+            product_template_ids.extend(map(
+                int, MagentoProductTemplate.update_templates_from_magento(
+                    mag_product_templates
                 )
+            ))
 
-        return map(int, product_templates)
+        return product_template_ids
 
 
 class ImportCatalogStart(ModelView):
@@ -676,6 +1007,14 @@ class ImportCatalogStart(ModelView):
     __name__ = 'magento.instance.import_catalog.start'
 
 
+class ImportCatalogStatus(ModelView):
+    'Import Catalog Status View'
+    __name__ = 'magento.instance.import_catalog.status'
+
+    failures_count = fields.Integer('Failures Count', readonly=True)
+    failures = fields.Text('Failures', readonly=True)
+
+
 class ImportCatalog(Wizard):
     '''
     Import Catalog
@@ -693,6 +1032,12 @@ class ImportCatalog(Wizard):
         ]
     )
     import_ = StateAction('product.act_template_form')
+    status = StateView(
+        'magento.instance.import_catalog.status',
+        'magento.instance_import_catalog_status', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+        ]
+    )
 
     def do_import_(self, action):
         """Handles the transition"""
@@ -702,14 +1047,36 @@ class ImportCatalog(Wizard):
         website = Website(Transaction().context.get('active_id'))
 
         self.import_category_tree(website)
-        product_ids = self.import_products(website)
+        product_ids, failures = self.import_products(website)
+
+        self.status.failures_count = len(failures)
+        self.status.failures = '\n'.join([
+            'Magento ID %s: %s' % (magento_id, message)
+            for magento_id, message in failures
+        ])
+
         action['pyson_domain'] = PYSONEncoder().encode(
             [('id', 'in', product_ids)])
         return action, {}
 
     def transition_import_(self):
+        """
+        Show the products whose details could not be fetched, if any
+        """
+        if self.status.failures_count:
+            return 'status'
         return 'end'
 
+    def default_status(self, fields):
+        """
+        Return the count and the list of products whose details could not be
+        fetched
+        """
+        return {
+            'failures_count': self.status.failures_count,
+            'failures': self.status.failures,
+        }
+
     def import_category_tree(self, website):
         """
         Imports the category tree and creates categories in a hierarchy same as
@@ -728,33 +1095,75 @@ class ImportCatalog(Wizard):
             category_tree = category_api.tree(website.magento_root_category_id)
             Category.create_tree_using_magento_data(category_tree)
 
-    def import_products(self, website):
+    def import_products(self, website, chunk_size=100):
         """
-        Imports products for the current instance
+        Imports products for the current instance. The details of the
+        products which are not imported yet are fetched in multiCalls of
+        `chunk_size` products each, and the products of a chunk are created
+        before the next chunk is fetched.
 
         :param website: Active record of website
+        :param chunk_size: Number of products fetched in one multiCall
+        :return: Tuple of the list of product template IDs and the list of
+                 (magento ID, fault message) of the products whose details
+                 could not be fetched
         """
         Product = Pool().get('product.template')
+        Category = Pool().get('product.category')
+        MagentoProductTemplate = Pool().get('magento.website.template')
 
         instance = website.instance
         Transaction().set_context({
             'magento_instance': instance.id,
             'magento_website': website.id
         })
+        failures = []
         with magento.Product(
             instance.url, instance.api_user, instance.api_key
         ) as product_api:
             magento_products = product_api.list()
 
-            products = []
-            for magento_product in magento_products:
-                products.append(
-                    Product.find_or_create_using_magento_id(
-                        magento_product['product_id']
+            # Resolve the categories of all the products at once, so that
+            # creating a product never needs a call for its category
+            category_map = Category.get_magento_category_map_for(set(
+                int(category_id)
+                for magento_product in magento_products
+                for category_id in magento_product.get('category_ids', [])
+            ))
+
+            template_ids = dict(
+                (record['magento_id'], record['template'])
+                for record in MagentoProductTemplate.search_read([
+                    ('website', '=', website.id),
+                ], fields_names=['magento_id', 'template'])
+            )
+
+            magento_ids = [
+                int(magento_product['product_id'])
+                for magento_product in magento_products
+            ]
+            new_magento_ids = sorted(set(magento_ids) - set(template_ids))
+            for index in xrange(0, len(new_magento_ids), chunk_size):
+                chunk = new_magento_ids[index:index + chunk_size]
+                products_data = product_api.multiCall([
+                    ['catalog_product.info', [magento_id]]
+                    for magento_id in chunk
+                ])
+                for magento_id, product_data in zip(chunk, products_data):
+                    if is_fault(product_data):
+                        failures.append(
+                            (magento_id, product_data.get('faultMessage'))
+                        )
+                        continue
+                    template = Product.create_using_magento_data(
+                        product_data, category_map
                     )
-                )
+                    template_ids[magento_id] = template.id
 
-        return map(int, products)
+        return [
+            template_ids[magento_id] for magento_id in magento_ids
+            if magento_id in template_ids
+        ], failures
 
 
 class ExportCatalogStart(ModelView):
@@ -773,12 +1182,7 @@ class ExportCatalogStart(ModelView):
             return []
 
         website = Website(Transaction().context['active_id'])
-        instance = website.instance
-
-        with magento.ProductAttributeSet(
-            instance.url, instance.api_user, instance.api_key
-        ) as attribute_set_api:
-            attribute_sets = attribute_set_api.list()
+        attribute_sets = website.instance.get_attribute_sets()
 
         return [(
             attribute_set['set_id'], attribute_set['name']
@@ -809,6 +1213,14 @@ class ExportCatalogStart(ModelView):
         return rv
 
 
+class ExportCatalogStatus(ModelView):
+    'Export Catalog Status View'
+    __name__ = 'magento.website.export_catalog.status'
+
+    failures_count = fields.Integer('Failures Count', readonly=True)
+    failures = fields.Text('Failures', readonly=True)
+
+
 class ExportCatalog(Wizard):
     '''Export catalog
 
@@ -824,12 +1236,19 @@ class ExportCatalog(Wizard):
         ]
     )
     export_ = StateAction('product.act_template_form')
+    status = StateView(
+        'magento.website.export_catalog.status',
+        'magento.website_export_catalog_status', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+        ]
+    )
 
     def do_export_(self, action):
         """
         Export the products selected to the selected category for this website
         """
         Website = Pool().get('magento.instance.website')
+        Template = Pool().get('product.template')
 
         website = Website(Transaction().context['active_id'])
 
@@ -837,13 +1256,35 @@ class ExportCatalog(Wizard):
             'magento_website': website.id,
             'magento_attribute_set': self.start.attribute_set,
         }):
-            for product in self.start.products:
-                product.export_to_magento(self.start.category)
+            products, failures = Template.export_all_to_magento(
+                self.start.products, self.start.category
+            )
+
+        self.status.failures_count = len(failures)
+        self.status.failures = '\n'.join([
+            '%s: %s' % (template.rec_name, message)
+            for template, message in failures
+        ])
 
         action['pyson_domain'] = PYSONEncoder().encode(
-            [('id', 'in', map(int, self.start.products))])
+            [('id', 'in', map(int, products))])
 
         return action, {}
 
     def transition_export_(self):
+        """
+        Show the products which magento failed to create, if any
+        """
+        if self.status.failures_count:
+            return 'status'
         return 'end'
+
+    def default_status(self, fields):
+        """
+        Return the count and the list of products which magento failed to
+        create
+        """
+        return {
+            'failures_count': self.status.failures_count,
+            'failures': self.status.failures,
+        }
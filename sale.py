@@ -11,23 +11,30 @@ import magento
 from decimal import Decimal
 import xmlrpclib
 
+from sql import Null
+from sql.functions import Substring
+
+from trytond import backend
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, Not, Bool
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.wizard import Wizard, StateView, Button, StateAction
 
+from .mixin import FindOrCreateMixin
+
 
 __all__ = [
     'MagentoOrderState', 'StockShipmentOut', 'Sale', 'SaleLine',
     'ImportOrdersStart', 'ImportOrders', 'ExportOrderStatusStart',
-    'ExportOrderStatus',
+    'ExportOrderStatus', 'SaleStateChange',
 ]
 __metaclass__ = PoolMeta
 
 
-class MagentoOrderState(ModelSQL, ModelView):
+class MagentoOrderState(FindOrCreateMixin, ModelSQL, ModelView):
     """
     Magento - Tryton Order State map
 
@@ -141,31 +148,37 @@ class MagentoOrderState(ModelSQL, ModelView):
         :param magento_data: Magento data in form of dict
         :return: List of active records of records created
         """
-        order_states_to_create = []
+        instance_id = Transaction().context.get('magento_instance')
 
+        order_states = cls.find_all_by_key(('instance', 'code'), [
+            (instance_id, code) for code in magento_data
+        ])
+
+        order_states_to_create = []
         for code, name in magento_data.iteritems():
-            if cls.search([
-                ('code', '=', code),
-                ('instance', '=', Transaction().context.get('magento_instance'))
-            ]):
+            if (instance_id, code) in order_states:
                 continue
 
             data_map = cls.get_tryton_state(code)
             data_map.update({
                 'name': name,
                 'code': code,
-                'instance': Transaction().context.get('magento_instance'),
+                'instance': instance_id,
             })
             order_states_to_create.append(data_map)
 
         return cls.create(order_states_to_create)
 
 
-class Sale:
+class Sale(FindOrCreateMixin):
     "Sale"
+    __metaclass__ = PoolMeta
     __name__ = 'sale.sale'
 
     magento_id = fields.Integer('Magento ID', readonly=True)
+    magento_increment_id = fields.Char(
+        'Magento Increment ID', readonly=True
+    )
     magento_instance = fields.Many2One(
         'magento.instance', 'Magento Instance', readonly=True,
     )
@@ -177,6 +190,10 @@ class Sale:
         fields.One2Many('magento.exception', None, 'Magento Exceptions'),
         'get_magento_exceptions'
     )
+    magento_state_changes = fields.One2Many(
+        'magento.sale.state_change', 'sale', 'Magento State Changes',
+        readonly=True
+    )
 
     @staticmethod
     def default_has_magento_exception():
@@ -201,30 +218,138 @@ class Sale:
             'magento_exception': 'Magento exception in sale %s.'
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        """
+        Register the class and add the indexes used to find the sales of
+        an instance by magento ID or by increment ID, and the recently changed
+        sales of a store view
+        """
+        TableHandler = backend.get('TableHandler')
+        Instance = Pool().get('magento.instance')
+        cursor = Transaction().cursor
+        sale = cls.__table__()
+        instance = Instance.__table__()
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['magento_instance', 'magento_id'], 'add')
+        table.index_action(['magento_instance', 'reference'], 'remove')
+        table.index_action(
+            ['magento_instance', 'magento_increment_id'], 'add'
+        )
+        table.index_action(['magento_store_view', 'write_date'], 'add')
+
+        # Migration: The increment ID was only stored in the reference,
+        # after the order prefix of the instance
+        cursor.execute(*instance.select(instance.id, instance.order_prefix))
+        for instance_id, order_prefix in cursor.fetchall():
+            order_prefix = order_prefix or ''
+            cursor.execute(*sale.update(
+                columns=[sale.magento_increment_id],
+                values=[Substring(sale.reference, len(order_prefix) + 1)],
+                where=(
+                    (sale.magento_instance == instance_id) &
+                    (sale.magento_increment_id == Null) &
+                    (sale.magento_id != Null) &
+                    (Substring(sale.reference, 1, len(order_prefix)) ==
+                        order_prefix)
+                )
+            ))
+
     @classmethod
     def validate(cls, sales):
         super(Sale, cls).validate(sales)
+        cls.check_store_view_instance(sales)
 
-        for sale in sales:
-            sale.check_store_view_instance()
-
-    def check_store_view_instance(self):
+    @classmethod
+    def check_store_view_instance(cls, sales):
         """
-        Checks if instance of store view is same as instance of sale order
+        Checks if instance of store view is same as instance of sale order,
+        with a single query for a batch of sales
+
+        :param sales: List of active records of sales
         """
-        if self.magento_id and \
-                self.magento_store_view.instance != self.magento_instance:
-            self.raise_user_error("invalid_instance")
+        StoreView = Pool().get('magento.store.store_view')
+        Store = Pool().get('magento.website.store')
+        Website = Pool().get('magento.instance.website')
+        cursor = Transaction().cursor
+        sale = cls.__table__()
+        store_view = StoreView.__table__()
+        store = Store.__table__()
+        website = Website.__table__()
+
+        for sub_sales in grouped_slice(sales):
+            cursor.execute(*sale.join(
+                store_view, condition=sale.magento_store_view == store_view.id
+            ).join(
+                store, condition=store_view.store == store.id
+            ).join(
+                website, condition=store.website == website.id
+            ).select(
+                sale.id,
+                where=(
+                    reduce_ids(sale.id, [s.id for s in sub_sales]) &
+                    (sale.magento_id != Null) & (sale.magento_id != 0) &
+                    (
+                        (sale.magento_instance == Null) |
+                        (sale.magento_instance != website.instance)
+                    )
+                ),
+                limit=1
+            ))
+            if cursor.fetchone():
+                cls.raise_user_error("invalid_instance")
 
-    def get_magento_exceptions(self, name):
+    @classmethod
+    def get_magento_exceptions(cls, sales, name):
         """
-        Return magento exceptions related to sale
+        Return magento exceptions related to the sales, searching the
+        exceptions of all the sales at once
+
+        :param sales: List of active records of sales
+        :param name: Field name
+        :return: Dictionary of list of exception IDs by sale ID
         """
         MagentoException = Pool().get('magento.exception')
 
-        return map(int, MagentoException.search([
-            ('origin', '=', '%s,%s' % (self.__name__, self.id)),
-        ]))
+        result = dict((sale.id, []) for sale in sales)
+        for sub_sales in grouped_slice(sales):
+            for exception in MagentoException.search_read([
+                ('origin', 'in', [
+                    '%s,%s' % (cls.__name__, sale.id) for sale in sub_sales
+                ]),
+            ], order=[('id', 'ASC')], fields_names=['origin']):
+                sale_id = int(exception['origin'].split(',')[1])
+                result[sale_id].append(exception['id'])
+        return result
+
+    @classmethod
+    def update_magento_exception_flag(cls, sales):
+        """
+        Sets the magento exception flag on the sales having exceptions, and
+        clears it on the others. Only the sales whose flag changes are
+        written.
+
+        :param sales: List of active records of sales
+        """
+        exceptions = cls.get_magento_exceptions(sales, 'magento_exceptions')
+
+        to_flag, to_clear = [], []
+        for sale in sales:
+            if exceptions[sale.id] and not sale.has_magento_exception:
+                to_flag.append(sale)
+            elif not exceptions[sale.id] and sale.has_magento_exception:
+                to_clear.append(sale)
+
+        args = []
+        if to_flag:
+            args.extend([to_flag, {'has_magento_exception': True}])
+        if to_clear:
+            args.extend([to_clear, {'has_magento_exception': False}])
+        if args:
+            cls.write(*args)
 
     @classmethod
     def confirm(cls, sales):
@@ -234,6 +359,66 @@ class Sale:
                 cls.raise_user_error('magento_exception', sale.reference)
         super(Sale, cls).confirm(sales)
 
+    @classmethod
+    def cancel(cls, sales):
+        "Journal the cancellation of magento sales"
+        candidates = cls.get_magento_state_change_candidates(sales, 'cancel')
+        super(Sale, cls).cancel(sales)
+        cls.log_magento_state_change(candidates, 'cancel')
+
+    @classmethod
+    def do(cls, sales):
+        "Journal the completion of magento sales"
+        candidates = cls.get_magento_state_change_candidates(sales, 'done')
+        super(Sale, cls).do(sales)
+        cls.log_magento_state_change(candidates, 'done')
+
+    @staticmethod
+    def get_magento_state_change_candidates(sales, state):
+        """
+        Returns the magento sales which are not yet in the given state and
+        hence could transition to it
+
+        :param sales: List of active records of sales
+        :param state: State the sales are transitioned to
+        :return: List of active records of sales
+        """
+        return [
+            sale for sale in sales
+            if sale.magento_id and sale.state != state
+        ]
+
+    @classmethod
+    def log_magento_state_change(cls, sales, state):
+        """
+        Records a state change entry for each of the sales which actually
+        reached the given state. These entries are later sent to magento by
+        the order status export. Nothing is recorded for the sales processed
+        on import, as magento is already in that state.
+
+        :param sales: List of active records of sales
+        :param state: State the sales were transitioned to
+        """
+        StateChange = Pool().get('magento.sale.state_change')
+
+        if Transaction().context.get('magento_import'):
+            return []
+
+        # Read the sales again as the transition might have skipped some
+        sales = [
+            sale for sale in cls.browse(map(int, sales))
+            if sale.state == state
+        ]
+        if not sales:
+            return []
+
+        return StateChange.create([{
+            'sale': sale.id,
+            'store_view': sale.magento_store_view.id,
+            'instance': sale.magento_instance.id,
+            'state': state,
+        } for sale in sales])
+
     @classmethod
     def find_or_create_using_magento_data(cls, order_data):
         """
@@ -291,12 +476,18 @@ class Sale:
                 order_data['customer_id']
             )
         else:
-            party = Party.create_using_magento_data({
-                'firstname': order_data['customer_firstname'],
-                'lastname': order_data['customer_lastname'],
-                'email': order_data['customer_email'],
-                'customer_id': 0
-            })
+            party = None
+            if store_view.merge_guest_customers:
+                party = Party.find_guest_using_magento_email(
+                    order_data['customer_email']
+                )
+            if not party:
+                party = Party.create_using_magento_data({
+                    'firstname': order_data['customer_firstname'],
+                    'lastname': order_data['customer_lastname'],
+                    'email': order_data['customer_email'],
+                    'customer_id': 0
+                })
 
         party_invoice_address = None
         if order_data['billing_address']:
@@ -332,6 +523,7 @@ class Sale:
             'invoice_address': party_invoice_address,
             'shipment_address': party_shipping_address or party_invoice_address,
             'magento_id': int(order_data['order_id']),
+            'magento_increment_id': order_data['increment_id'],
             'magento_instance': instance.id,
             'magento_store_view': store_view.id,
             'invoice_method': tryton_state['invoice_method'],
@@ -355,7 +547,15 @@ class Sale:
         sale = cls.get_sale_using_magento_data(order_data)
 
         sale.add_lines_using_magento_data(order_data)
-        sale.save()
+
+        # A concurrent import of the same order may have created the sale
+        # meanwhile, which is then returned as it is
+        found, = cls.create_or_get(
+            ('magento_id', 'magento_instance'),
+            [(sale.magento_id, sale.magento_instance)], sale.save
+        )
+        if found.id != sale.id:
+            return found
 
         # Process sale now
         tryton_state = MagentoOrderState.get_tryton_state(order_data['state'])
@@ -384,6 +584,9 @@ class Sale:
         """
         Bom = Pool().get('production.bom')
 
+        # The taxes of all the lines are found from the same store view
+        store_view = self.magento_store_view
+
         for item in order_data['items']:
 
             # If the product is a child product of a bundle product, do not
@@ -392,7 +595,9 @@ class Sale:
                     item['parent_item_id']:
                 continue
 
-            sale_line = self.get_sale_line_using_magento_data(item)
+            sale_line = self.get_sale_line_using_magento_data(
+                item, store_view
+            )
             if sale_line is not None:
                 self.lines.append(sale_line)
 
@@ -411,15 +616,21 @@ class Sale:
                 self.get_discount_line_data_using_magento_data(order_data)
             )
 
-    def get_sale_line_using_magento_data(self, item):
+    def get_sale_line_using_magento_data(self, item, store_view=None):
         """
         Get sale.line data from magento data.
+
+        :param item: Item data from magento
+        :param store_view: Active record of the store view whose taxes are
+                           used, the store view of the sale by default
         """
         SaleLine = Pool().get('sale.line')
         ProductTemplate = Pool().get('product.template')
         MagentoException = Pool().get('magento.exception')
         Uom = Pool().get('product.uom')
-        StoreView = Pool().get('magento.store.store_view')
+
+        if store_view is None:
+            store_view = self.magento_store_view
 
         sale_line = None
         unit, = Uom.search([('name', '=', 'Unit')])
@@ -453,7 +664,6 @@ class Sale:
                 'product': product,
             })
             if item.get('tax_percent') and Decimal(item.get('tax_percent')):
-                store_view = StoreView.get_current_store_view()
                 taxes = store_view.get_taxes(
                     Decimal(item['tax_percent']) / 100
                 )
@@ -516,12 +726,8 @@ class Sale:
         :type order_increment_id: string
         :returns: Active record of sale order created
         """
-        Instance = Pool().get('magento.instance')
-
-        instance = Instance(Transaction().context.get('magento_instance'))
-
         sales = cls.search([
-            ('reference', '=', instance.order_prefix + order_increment_id),
+            ('magento_increment_id', '=', order_increment_id),
             ('magento_instance', '=',
                 Transaction().context.get('magento_instance'))
         ])
@@ -602,17 +808,22 @@ class Sale:
 
         data = MagentoOrderState.get_tryton_state(magento_state)
 
-        # If order is canceled, just cancel it
-        if data['tryton_state'] == 'sale.cancel':
-            Sale.cancel([self])
-            return
+        # The state comes from magento, so it must not be journaled to be
+        # exported back
+        with Transaction().set_context(magento_import=True):
+            # If order is canceled, just cancel it
+            if data['tryton_state'] == 'sale.cancel':
+                Sale.cancel([self])
+                return
 
-        # Order is not canceled, move it to quotation
-        Sale.quote([self])
-        Sale.confirm([self])
+            # Order is not canceled, move it to quotation
+            Sale.quote([self])
+            Sale.confirm([self])
 
-        if data['tryton_state'] not in ['sale.quotation', 'sale.confirmed']:
-            Sale.process([self])
+            if data['tryton_state'] not in [
+                'sale.quotation', 'sale.confirmed'
+            ]:
+                Sale.process([self])
 
     def export_order_status_to_magento(self):
         """
@@ -624,7 +835,6 @@ class Sale:
             return self
 
         instance = self.magento_instance
-        increment_id = self.reference.split(instance.order_prefix)[1]
         # This try except is placed because magento might not accept this
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
@@ -632,17 +842,97 @@ class Sale:
             with magento.Order(
                 instance.url, instance.api_user, instance.api_key
             ) as order_api:
-                if self.state == 'cancel':
-                    order_api.cancel(increment_id)
-                elif self.state == 'done':
-                    # TODO: update shipping and invoice
-                    order_api.addcomment(increment_id, 'complete')
+                self.export_state_to_magento(order_api, self.state)
         except xmlrpclib.Fault, exception:
             if exception.faultCode == 103:
                 return self
 
         return self
 
+    def export_state_to_magento(self, order_api, state):
+        """
+        Send the given state of this sale to magento using an already open
+        order API session
+
+        :param order_api: Active session of magento order API
+        :param state: Tryton state of the sale to be exported
+        """
+        if state == 'cancel':
+            order_api.cancel(self.magento_increment_id)
+        elif state == 'done':
+            # TODO: update shipping and invoice
+            order_api.addcomment(self.magento_increment_id, 'complete')
+
+
+class SaleStateChange(ModelSQL, ModelView):
+    """
+    Magento Sale State Change
+
+    A journal of the state transitions of magento sales in tryton. An entry
+    is recorded whenever a magento sale is canceled or done, and the order
+    status export sends only the entries which are not yet exported.
+    """
+    __name__ = 'magento.sale.state_change'
+    _rec_name = 'sale'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    store_view = fields.Many2One(
+        'magento.store.store_view', 'Store View', required=True,
+        readonly=True, select=True
+    )
+    instance = fields.Many2One(
+        'magento.instance', 'Magento Instance', required=True, readonly=True,
+        select=True
+    )
+    state = fields.Selection([
+        ('cancel', 'Canceled'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
+    exported = fields.Boolean('Exported', readonly=True, select=True)
+
+    @staticmethod
+    def default_exported():
+        return False
+
+    @classmethod
+    def export_to_magento(cls, state_changes):
+        """
+        Export the given state changes to magento. A single order API session
+        is used for all the state changes of an instance. State changes which
+        magento refuses due to its workflow constraints are considered as
+        exported, the others are left to be retried by the next export.
+
+        :param state_changes: List of active records of state changes
+        :return: List of active records of state changes exported
+        """
+        changes_by_instance = {}
+        for state_change in state_changes:
+            changes_by_instance.setdefault(
+                state_change.instance, []
+            ).append(state_change)
+
+        exported = []
+        for instance, changes in changes_by_instance.iteritems():
+            with magento.Order(
+                instance.url, instance.api_user, instance.api_key
+            ) as order_api:
+                for state_change in changes:
+                    try:
+                        state_change.sale.export_state_to_magento(
+                            order_api, state_change.state
+                        )
+                    except xmlrpclib.Fault, exception:
+                        if exception.faultCode != 103:
+                            continue
+                    exported.append(state_change)
+
+        if exported:
+            cls.write(exported, {'exported': True})
+        return exported
+
 
 class ImportOrdersStart(ModelView):
     "Import Sale Order Start View"
@@ -734,9 +1024,10 @@ class ExportOrderStatus(Wizard):
         """
         return {
             'message': "This wizard will export orders status to magento " +
-                "for this store view. All the orders edited/updated after " +
-                "the Last Order Export Time will be exported. [NOTE: This " +
-                "feature is currently available only for Canceled Orders]"
+                "for this store view. All the orders canceled or done since " +
+                "their status was last exported will be exported. [NOTE: " +
+                "This feature is currently available only for Canceled and " +
+                "Done Orders]"
         }
 
     def do_export_(self, action):
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    stock
+
+    Stock
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+
+__all__ = ['Move']
+__metaclass__ = PoolMeta
+
+
+class Move:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    @classmethod
+    def assign(cls, moves):
+        super(Move, cls).assign(moves)
+        cls.mark_magento_stock_dirty(moves)
+
+    @classmethod
+    def assign_try(cls, moves, with_childs=True, grouping=('product',)):
+        # The moves are assigned one by one, so mark the stock of their
+        # products once for the whole batch
+        with Transaction().set_context(_magento_stock_dirty_deferred=True):
+            result = super(Move, cls).assign_try(
+                moves, with_childs=with_childs, grouping=grouping
+            )
+        cls.mark_magento_stock_dirty(moves)
+        return result
+
+    @classmethod
+    def do(cls, moves):
+        super(Move, cls).do(moves)
+        cls.mark_magento_stock_dirty(moves)
+
+    @classmethod
+    def cancel(cls, moves):
+        super(Move, cls).cancel(moves)
+        cls.mark_magento_stock_dirty(moves)
+
+    @classmethod
+    def mark_magento_stock_dirty(cls, moves):
+        """
+        Marks the stock of the products of the moves as changed on all the
+        websites the products are exported to, so that the stock is pushed
+        to magento by the next export of stock changes
+
+        :param moves: List of active records of moves
+        """
+        MagentoProductTemplate = Pool().get('magento.website.template')
+
+        if Transaction().context.get('_magento_stock_dirty_deferred'):
+            return
+
+        template_ids = list(set(move.product.template.id for move in moves))
+        if template_ids:
+            MagentoProductTemplate.mark_stock_dirty(template_ids)
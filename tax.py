@@ -6,6 +6,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
 
 
 class StoreViewTax(ModelSQL, ModelView):
@@ -35,6 +36,22 @@ class StoreViewTax(ModelSQL, ModelView):
              'unique_tax_percent_per_store_view')
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(StoreViewTax, cls).create(vlist)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(StoreViewTax, cls).write(*args)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
+
+    @classmethod
+    def delete(cls, store_view_taxes):
+        super(StoreViewTax, cls).delete(store_view_taxes)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
+
 
 class StoreViewTaxRelation(ModelSQL):
     "Store View Tax Relation"
@@ -48,3 +65,19 @@ class StoreViewTaxRelation(ModelSQL):
         'account.tax', 'Tax', ondelete='RESTRICT',
         select=True, required=True
     )
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(StoreViewTaxRelation, cls).create(vlist)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(StoreViewTaxRelation, cls).write(*args)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
+
+    @classmethod
+    def delete(cls, relations):
+        super(StoreViewTaxRelation, cls).delete(relations)
+        Pool().get('magento.store.store_view').clear_tax_rate_cache()
@@ -11,9 +11,16 @@ import sys
 import os
 
 import unittest
+from decimal import Decimal
+from datetime import datetime
+
+from sql import Column, Literal
+from mock import patch, MagicMock, call
+
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.transaction import Transaction
-from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from tests.test_base import TestBase
 
 DIR = os.path.abspath(os.path.normpath(
@@ -113,6 +120,246 @@ class TestModels(TestBase):
             self.assertEqual(store_view.company, self.store.company)
             self.assertEqual(store_view.website, self.store.website)
 
+            # The function fields can be searched
+            self.assertIn(store_view, self.StoreView.search([
+                ('instance', '=', self.instance1.id),
+            ]))
+            self.assertNotIn(store_view, self.StoreView.search([
+                ('instance', '=', self.instance2.id),
+            ]))
+            self.assertIn(store_view, self.StoreView.search([
+                ('website.name', '=', self.store.website.name),
+            ]))
+            self.assertIn(store_view, self.StoreView.search([
+                ('company', '=', self.company.id),
+            ]))
+            self.assertEqual(self.Store.search([
+                ('instance', '=', self.instance2.id),
+            ]), [])
+            self.assertIn(self.website1, self.Website.search([
+                ('company', '=', self.company.id),
+            ]))
+
+    def test0045find_or_create_all(self):
+        '''
+        Tests that mapping records are found or created in bulk by their key
+        '''
+        Carrier = POOL.get('magento.instance.carrier')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            flatrate, = Carrier.create([{
+                'code': 'flatrate',
+                'title': 'Flat Rate',
+                'instance': self.instance1.id,
+            }])
+
+            carriers = Carrier.find_or_create_all(('instance', 'code'), [{
+                'code': code,
+                'title': code.title(),
+                'instance': instance.id,
+            } for instance, code in [
+                (self.instance1, 'flatrate'),
+                (self.instance1, 'tablerate'),
+                (self.instance2, 'flatrate'),
+                (self.instance1, 'tablerate'),
+            ]])
+
+            self.assertEqual(len(carriers), 4)
+            self.assertEqual(carriers[0], flatrate)
+            self.assertEqual(carriers[1], carriers[3])
+            self.assertNotEqual(carriers[2], flatrate)
+            self.assertEqual(carriers[2].instance, self.instance2)
+            self.assertEqual(Carrier.search([], count=True), 3)
+
+            self.assertEqual(
+                Carrier.find_all_by_key(('instance', 'code'), [
+                    (self.instance2, 'flatrate'), (self.instance2, 'other'),
+                ]),
+                {(self.instance2.id, 'flatrate'): carriers[2]}
+            )
+
+    def test0047savepoint(self):
+        '''
+        Tests that the savepoint of a block is released when the block
+        succeeds, and rolled back when it fails
+        '''
+        mixin = sys.modules['trytond.modules.magento.mixin']
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            cursor = MagicMock()
+            with patch.object(mixin.backend, 'name', lambda: 'postgresql'):
+                with patch.object(txn, 'cursor', cursor):
+                    with mixin.savepoint('test'):
+                        pass
+                    with self.assertRaises(ValueError):
+                        with mixin.savepoint('test'):
+                            raise ValueError
+            self.assertEqual(cursor.execute.call_args_list, [
+                call('SAVEPOINT test'),
+                call('RELEASE SAVEPOINT test'),
+                call('SAVEPOINT test'),
+                call('ROLLBACK TO SAVEPOINT test'),
+            ])
+
+    def test0050metadata_cache(self):
+        '''
+        Tests that metadata from magento is cached per instance until it is
+        cleared
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.Instance.clear_metadata_cache(
+                [self.instance1, self.instance2]
+            )
+
+            calls = []
+
+            def fetch():
+                calls.append(1)
+                return [{'set_id': 4, 'name': 'Default'}]
+
+            for instance in (self.instance1, self.instance1, self.instance2):
+                self.assertEqual(
+                    instance.get_metadata('attribute_sets', fetch),
+                    [{'set_id': 4, 'name': 'Default'}]
+                )
+            self.assertEqual(len(calls), 2)
+
+            # The cached value can not be changed by the caller
+            self.instance1.get_metadata('attribute_sets', fetch)[0]['x'] = 1
+            self.assertEqual(
+                self.instance1.get_metadata('attribute_sets', fetch),
+                [{'set_id': 4, 'name': 'Default'}]
+            )
+            self.assertEqual(len(calls), 2)
+
+            # Clearing the cache of an instance keeps that of the others
+            self.Instance.clear_metadata_cache([self.instance1])
+            self.instance1.get_metadata('attribute_sets', fetch)
+            self.instance2.get_metadata('attribute_sets', fetch)
+            self.assertEqual(len(calls), 3)
+
+            # A refresh fetches the metadata again and caches it
+            self.instance1.get_metadata('attribute_sets', fetch, refresh=True)
+            self.assertEqual(len(calls), 4)
+            self.instance1.get_metadata('attribute_sets', fetch)
+            self.assertEqual(len(calls), 4)
+
+            # Nothing is cached without a duration
+            self.Instance.write([self.instance2], {'metadata_cache_ttl': 0})
+            self.Instance.clear_metadata_cache([self.instance2])
+            self.instance2.get_metadata('attribute_sets', fetch)
+            self.instance2.get_metadata('attribute_sets', fetch)
+            self.assertEqual(len(calls), 6)
+
+    def test0055tax_rate_map(self):
+        '''
+        Tests that the taxes of a store view are found by rate from a cached
+        map, which is refreshed when the store view taxes change
+        '''
+        Tax = POOL.get('account.tax')
+        StoreViewTax = POOL.get('magento.store.store_view.tax')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.StoreView.clear_tax_rate_cache()
+
+            tax1, tax2, tax3 = Tax.create([{
+                'name': name,
+                'description': name,
+                'type': 'none',
+                'company': self.company.id,
+            } for name in ('Tax 1', 'Tax 2', 'Tax 3')])
+            store_view_tax, = StoreViewTax.create([{
+                'store_view': self.store_view.id,
+                'tax_percent': Decimal('0.0825'),
+                'taxes': [('add', [tax1.id, tax2.id])],
+            }])
+
+            self.assertEqual(
+                set(self.store_view.get_taxes(Decimal('8.25') / 100)),
+                set([tax1, tax2])
+            )
+            self.assertEqual(
+                set(self.store_view.get_taxes(Decimal('0.08250000'))),
+                set([tax1, tax2])
+            )
+            self.assertEqual(self.store_view.get_taxes(Decimal('0.1')), [])
+
+            StoreViewTax.write([store_view_tax], {
+                'taxes': [('remove', [tax1.id]), ('add', [tax3.id])],
+            })
+            self.assertEqual(
+                set(self.store_view.get_taxes(Decimal('0.0825'))),
+                set([tax2, tax3])
+            )
+
+            StoreViewTax.delete([store_view_tax])
+            self.assertEqual(
+                self.store_view.get_taxes(Decimal('0.0825')), []
+            )
+            self.StoreView.clear_tax_rate_cache()
+
+    def get_query_plan(self, query):
+        '''
+        Returns the query plan of the database for the query as text
+        '''
+        cursor = Transaction().cursor
+        sql, params = tuple(query)
+        if backend.name() == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        else:
+            # The tables of the tests are too small for an index to be
+            # cheaper than a sequential scan
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+        return ' '.join(unicode(row) for row in cursor.fetchall())
+
+    def test0060lookup_indexes(self):
+        '''
+        Tests that the lookups of magento records use an index
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            for model_name, where, index in [
+                ('sale.sale', [
+                    ('magento_instance', 1), ('magento_id', 1),
+                ], 'sale_sale_magento_instance_magento_id_index'),
+                ('sale.sale', [
+                    ('magento_instance', 1),
+                    ('magento_increment_id', '100000001'),
+                ], 'sale_sale_magento_instance_magento_increment_id_index'),
+                ('magento.website.template', [
+                    ('website', 1), ('magento_id', 1),
+                ], 'magento_website_template_website_magento_id_index'),
+                ('magento.website.party', [
+                    ('website', 1), ('magento_id', 1),
+                ], 'magento_website_party_website_magento_id_index'),
+                ('magento.instance.product_category', [
+                    ('instance', 1), ('magento_id', 1),
+                ], 'magento_instance_product_category_instance_magento_id_'
+                    'index'),
+            ]:
+                table = POOL.get(model_name).__table__()
+                condition = Literal(True)
+                for name, value in where:
+                    condition &= Column(table, name) == value
+                self.assertIn(
+                    index, self.get_query_plan(
+                        table.select(table.id, where=condition)
+                    )
+                )
+
+            table = POOL.get('sale.sale').__table__()
+            self.assertIn(
+                'sale_sale_magento_store_view_write_date_index',
+                self.get_query_plan(table.select(table.id, where=(
+                    (table.magento_store_view == 1) &
+                    (table.write_date >= datetime(2015, 1, 1))
+                )))
+            )
+
 
 def suite():
     """
@@ -175,6 +175,24 @@ class TestParty(TestBase):
             parties = MagentoParty.search([])
             self.assertEqual(len(parties), 3)
 
+            # A magento customer cannot be linked twice to a website, unlike
+            # guest customers
+            with self.assertRaises(UserError):
+                MagentoParty.create([{
+                    'magento_id': parties[0].magento_id,
+                    'website': parties[0].website.id,
+                    'party': party.id,
+                }])
+            MagentoParty.create([{
+                'magento_id': 0,
+                'website': self.website1.id,
+                'party': party.id,
+            }, {
+                'magento_id': 0,
+                'website': self.website1.id,
+                'party': party.id,
+            }])
+
     def test0030_import_addresses_from_magento(self):
         """
         Test address import as party addresses and make sure no duplication
@@ -287,6 +305,63 @@ class TestParty(TestBase):
                 address.match_with_magento_data(load_json('addresses', '1e'))
             )
 
+    def test0050_fill_guest_emails(self):
+        """
+        Tests that the migration fills the email of the guest customers
+        from the first email of their party
+        """
+        MagentoParty = POOL.get('magento.website.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+
+            self.setup_defaults()
+
+            guest, no_email, customer = self.Party.create([{
+                'name': 'Guest',
+                'contact_mechanisms': [('create', [{
+                    'type': 'email',
+                    'value': ' Guest@Example.com ',
+                }, {
+                    'type': 'email',
+                    'value': 'other@example.com',
+                }])],
+            }, {
+                'name': 'Guest without email',
+            }, {
+                'name': 'Customer',
+                'contact_mechanisms': [('create', [{
+                    'type': 'email',
+                    'value': 'customer@example.com',
+                }])],
+            }])
+            guest_link, no_email_link, customer_link = MagentoParty.create([{
+                'magento_id': 0,
+                'website': self.website1.id,
+                'party': guest.id,
+            }, {
+                'magento_id': 0,
+                'website': self.website1.id,
+                'party': no_email.id,
+            }, {
+                'magento_id': 1,
+                'website': self.website1.id,
+                'party': customer.id,
+            }])
+
+            MagentoParty.fill_guest_emails()
+
+            # The links are updated in SQL, search to bypass the cache
+            self.assertEqual(
+                MagentoParty.search([('email', '=', 'guest@example.com')]),
+                [guest_link]
+            )
+            self.assertEqual(
+                MagentoParty.search(
+                    [('email', '=', None)], order=[('id', 'ASC')]
+                ),
+                [no_email_link, customer_link]
+            )
+
 
 def suite():
     """
@@ -14,9 +14,11 @@ import magento
 from mock import patch, MagicMock
 
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -106,6 +108,20 @@ class TestProduct(TestBase):
                     ], count=True) == 0
                 )
 
+                # Importing the tree again does not create any category
+                category_map = Category.create_tree_using_magento_data(
+                    category_tree
+                )
+                self.assertEqual(
+                    Category.search([], count=True), categories_after_import
+                )
+                self.assertEqual(
+                    len(category_map), MagentoCategory.search([
+                        ('instance', '=', self.instance1)
+                    ], count=True)
+                )
+                self.assertEqual(category_map[1], root_category.id)
+
     def test_0020_import_simple_product(self):
         """
         Test the import of simple product using Magento Data
@@ -157,6 +173,202 @@ class TestProduct(TestBase):
                     count=True) == 0
                 )
 
+    def test_0025_import_product_using_category_map(self):
+        """
+        Test the import of products resolving their categories from the
+        category map of the instance
+        """
+        Category = POOL.get('product.category')
+        ProductTemplate = POOL.get('product.template')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({
+                'magento_instance': self.instance1,
+                'magento_website': self.website1,
+                'company': self.company,
+            }):
+                category_api = MagicMock(spec=magento.Category)
+                handle = category_api.return_value.__enter__.return_value
+                handle.tree.return_value = load_json(
+                    'categories', 'category_tree'
+                )
+
+                # The tree is fetched once when a category is not known
+                with patch('magento.Category', category_api, create=True):
+                    category_map = Category.get_magento_category_map_for([8])
+                    self.assertEqual(
+                        Category.get_magento_category_map_for([8]),
+                        category_map
+                    )
+                self.assertEqual(handle.tree.call_count, 1)
+
+                with patch('magento.Category', category_api, create=True):
+                    template = ProductTemplate.create_using_magento_data(
+                        load_json('products', '17'), category_map
+                    )
+                    self.assertEqual(template.category.id, category_map[8])
+
+                    # A category missing in the map is not fetched
+                    template = ProductTemplate.create_using_magento_data(
+                        load_json('products', '135'), {}
+                    )
+                    self.assertEqual(
+                        template.category.name,
+                        'Unclassified Magento Products'
+                    )
+                self.assertFalse(handle.info.called)
+
+    def test_0027_import_catalog(self):
+        """
+        Test the import of the catalog of a website, fetching the details of
+        the new products in multiCalls
+        """
+        ProductTemplate = POOL.get('product.template')
+        ImportCatalog = POOL.get(
+            'magento.instance.import_catalog', type='wizard'
+        )
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({
+                'magento_instance': self.instance1,
+                'magento_website': self.website1,
+                'company': self.company,
+            }):
+                template17 = ProductTemplate.create_using_magento_data(
+                    load_json('products', '17-wo-category')
+                )
+
+                category_api = MagicMock(spec=magento.Category)
+                category_api.return_value.__enter__.return_value \
+                    .tree.return_value = load_json(
+                        'categories', 'category_tree'
+                    )
+                product_api = MagicMock(spec=magento.Product)
+                handle = product_api.return_value.__enter__.return_value
+                handle.list.return_value = [
+                    {'product_id': '17', 'category_ids': ['8', '13']},
+                    {'product_id': '135', 'category_ids': ['17']},
+                    {'product_id': '144', 'category_ids': []},
+                    {'product_id': '999', 'category_ids': []},
+                ]
+                handle.multiCall.side_effect = lambda calls: [
+                    {
+                        'isFault': True, 'faultCode': 101,
+                        'faultMessage': 'Product not exists.',
+                    } if args[0] == 999 else load_json(
+                        'products', str(args[0])
+                    ) for _, args in calls
+                ]
+
+                session_id, _, _ = ImportCatalog.create()
+                import_catalog = ImportCatalog(session_id)
+                with patch('magento.Category', category_api, create=True):
+                    with patch('magento.Product', product_api, create=True):
+                        template_ids, failures = \
+                            import_catalog.import_products(
+                                self.website1, chunk_size=1
+                            )
+
+                # Only the new products are fetched, and a product which
+                # could not be fetched does not stop the import
+                self.assertEqual(handle.multiCall.call_count, 3)
+                self.assertEqual(failures, [(999, 'Product not exists.')])
+                self.assertFalse(handle.info.called)
+
+                template135 = ProductTemplate.find_using_magento_id(135)
+                template144 = ProductTemplate.find_using_magento_id(144)
+                self.assertEqual(
+                    template_ids,
+                    [template17.id, template135.id, template144.id]
+                )
+                self.assertEqual(
+                    template135.category.magento_ids[0].magento_id, 17
+                )
+
+    def test_0028_import_product_created_concurrently(self):
+        """
+        Test that creating a product which was created meanwhile by a
+        concurrent import returns the existing product if it is visible, and
+        asks for a retry otherwise
+        """
+        Category = POOL.get('product.category')
+        ProductTemplate = POOL.get('product.template')
+        MagentoProductTemplate = POOL.get('magento.website.template')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        def conflict():
+            raise DatabaseIntegrityError(
+                'duplicate key value violates unique constraint '
+                '"magento_website_template_magento_id_website_unique"'
+            )
+
+        def other_error():
+            raise DatabaseIntegrityError(
+                'null value in column "template" violates not-null '
+                'constraint'
+            )
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({
+                'magento_instance': self.instance1.id,
+                'magento_website': self.website1.id,
+                'company': self.company,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '8')
+                )
+                product_data = load_json('products', '17')
+                template = ProductTemplate.create_using_magento_data(
+                    product_data
+                )
+                link, = template.magento_ids
+
+                # The product created by the concurrent import is visible
+                self.assertEqual(
+                    MagentoProductTemplate.create_or_get(
+                        ('magento_id', 'website'),
+                        [(17, self.website1.id)], conflict
+                    ), [link]
+                )
+
+                # It is not visible yet
+                with self.assertRaises(DatabaseOperationalError):
+                    MagentoProductTemplate.create_or_get(
+                        ('magento_id', 'website'),
+                        [(18, self.website1.id)], conflict
+                    )
+
+                # Other errors are not mistaken for a conflict
+                with self.assertRaises(DatabaseIntegrityError):
+                    MagentoProductTemplate.create_or_get(
+                        ('magento_id', 'website'),
+                        [(17, self.website1.id)], other_error
+                    )
+
+                # The ORM keeps the database error of a unique constraint
+                # only for the records created by create_or_get
+                try:
+                    conflict()
+                except DatabaseIntegrityError, exception:
+                    pass
+                with self.assertRaises(UserError):
+                    MagentoProductTemplate._ModelSQL__raise_integrity_error(
+                        exception, {}
+                    )
+                with txn.set_context(
+                    _magento_create_or_get='magento.website.template'
+                ):
+                    MagentoProductTemplate._ModelSQL__raise_integrity_error(
+                        exception, {}
+                    )
+
     def test_0300_import_product_wo_categories(self):
         """
         Test the import of a product using magento data which doesn't
@@ -264,6 +476,7 @@ class TestProduct(TestBase):
         Check if the product template gets updated using magento data
         """
         ProductTemplate = POOL.get('product.template')
+        Product = POOL.get('product.product')
         Category = POOL.get('product.category')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
@@ -318,11 +531,31 @@ class TestProduct(TestBase):
                     product_template2.products[0].description
                 )
 
+                # Nothing is written when the data from magento did not change
+                with patch.object(ProductTemplate, 'write') as template_write:
+                    with patch.object(Product, 'write') as product_write:
+                        ProductTemplate(product_template2.id) \
+                            .update_from_magento_using_data(product_data)
+                self.assertFalse(template_write.called)
+                self.assertFalse(product_write.called)
+
+                # Only the changed values are written
+                product_data['price'] = '100.0000'
+                with patch.object(ProductTemplate, 'write') as template_write:
+                    with patch.object(Product, 'write') as product_write:
+                        ProductTemplate(product_template2.id) \
+                            .update_from_magento_using_data(product_data)
+                template_write.assert_called_once_with(
+                    [product_template2], {'list_price': Decimal('100.0000')}
+                )
+                self.assertFalse(product_write.called)
+
     def test_0103_update_product_using_magento_id(self):
         """
         Check if the product template gets updated using magento ID
         """
         ProductTemplate = POOL.get('product.template')
+        MagentoProductTemplate = POOL.get('magento.website.template')
         Category = POOL.get('product.category')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
@@ -372,6 +605,21 @@ class TestProduct(TestBase):
                     product_template2.products[0].description
                 )
 
+                # Update the products from their magento product templates
+                ProductTemplate.write([product_template1], {'name': 'Old'})
+                product_api = mock_product_api()
+                with patch('magento.Product', product_api, create=True):
+                    templates = MagentoProductTemplate \
+                        .update_templates_from_magento(
+                            product_template1.magento_ids
+                        )
+                self.assertEqual(templates, [product_template1])
+                product_api.return_value.info.assert_called_once_with(135)
+                self.assertEqual(
+                    ProductTemplate(product_template1.id).name,
+                    'Anashria Womens Premier Leather Sandal'
+                )
+
     def test_0080_export_product_stock_information(self):
         """
         This test checks if the method to call for updation of product
@@ -404,11 +652,183 @@ class TestProduct(TestBase):
                 ):
                     self.website1.export_inventory_to_magento()
 
+    def test_0085_export_stock_changes(self):
+        """
+        Checks that stock moves mark the stock of the products as changed
+        and that only those products are exported
+        """
+        ProductTemplate = POOL.get('product.template')
+        Category = POOL.get('product.category')
+        MagentoProductTemplate = POOL.get('magento.website.template')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'magento_instance': self.instance1.id,
+                'magento_website': self.website1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                Category.create_using_magento_data(
+                    load_json('categories', '8')
+                )
+                template1 = ProductTemplate.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                ProductTemplate.find_or_create_using_magento_data(
+                    load_json('products', '17')
+                )
+                mag_template1, = template1.magento_ids
+                self.assertFalse(mag_template1.stock_dirty)
+
+                supplier, = Location.search([('code', '=', 'SUP')])
+                storage, = Location.search([('code', '=', 'STO')])
+                move, = Move.create([{
+                    'product': template1.products[0].id,
+                    'uom': template1.default_uom.id,
+                    'quantity': 5,
+                    'from_location': supplier.id,
+                    'to_location': storage.id,
+                    'unit_price': Decimal('1'),
+                    'currency': self.company.currency.id,
+                    'company': self.company.id,
+                }])
+                Move.do([move])
+
+                self.assertEqual(
+                    MagentoProductTemplate.search([
+                        ('stock_dirty', '=', True)
+                    ]), [mag_template1]
+                )
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.Website.export_stock_changes([self.website1])
+
+                inventory_api.return_value.update.assert_called_once_with(
+                    135, {'qty': 5, 'is_in_stock': '1'}
+                )
+                mag_template1 = MagentoProductTemplate(mag_template1.id)
+                self.assertFalse(mag_template1.stock_dirty)
+                self.assertTrue(mag_template1.magento_is_in_stock)
+
+                # The moves assigned together mark the stock once
+                lost_found, = Location.search([('type', '=', 'lost_found')])
+                moves = Move.create([{
+                    'product': template1.products[0].id,
+                    'uom': template1.default_uom.id,
+                    'quantity': 1,
+                    'from_location': storage.id,
+                    'to_location': lost_found.id,
+                    'unit_price': Decimal('1'),
+                    'currency': self.company.currency.id,
+                    'company': self.company.id,
+                } for _ in range(2)])
+                with patch.object(
+                    MagentoProductTemplate, 'mark_stock_dirty'
+                ) as mark_stock_dirty:
+                    self.assertTrue(Move.assign_try(moves))
+                mark_stock_dirty.assert_called_once_with([template1.id])
+                self.assertEqual(
+                    [m.state for m in Move.browse(map(int, moves))],
+                    ['assigned', 'assigned']
+                )
+                with patch.object(MagentoProductTemplate, 'mark_stock_dirty'):
+                    Move.cancel(moves)
+
+                # A product linked to two websites of the same instance is
+                # updated only once on the instance
+                website3, = self.Website.create([{
+                    'name': 'A test website 3',
+                    'magento_id': 3,
+                    'code': 'test_code_3',
+                    'instance': self.instance1,
+                }])
+                MagentoProductTemplate.create([{
+                    'magento_id': 135,
+                    'website': website3.id,
+                    'template': template1.id,
+                }])
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    with patch.object(
+                        MagentoProductTemplate, 'write'
+                    ) as write:
+                        self.Website.export_inventory(
+                            [self.website1, website3]
+                        )
+
+                self.assertEqual(inventory_api.call_count, 1)
+                self.assertEqual(
+                    inventory_api.return_value.update.call_count, 2
+                )
+                inventory_api.return_value.update.assert_any_call(
+                    135, {'qty': 5, 'is_in_stock': '1'}
+                )
+                inventory_api.return_value.update.assert_any_call(
+                    17, {'qty': 0, 'is_in_stock': '0'}
+                )
+
+                # Only the links whose stock flags change are written
+                mag_template3, = website3.magento_product_templates
+                write.assert_called_once_with([mag_template3], {
+                    'stock_dirty': False,
+                    'magento_is_in_stock': True,
+                })
+
+                # A single session is opened on the instance even when the
+                # links are exported in several chunks
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    with patch.object(
+                        self.Website, 'iter_magento_product_templates',
+                        lambda website: iter([
+                            [link] for link in
+                            website.magento_product_templates
+                        ])
+                    ):
+                        self.Website.export_inventory(
+                            [self.website1, website3]
+                        )
+                        self.assertEqual(inventory_api.call_count, 1)
+                        self.assertEqual(
+                            inventory_api.return_value.update.call_count, 2
+                        )
+
+                        inventory_api.reset_mock()
+                        self.website1.export_inventory_to_magento()
+                        self.assertEqual(inventory_api.call_count, 1)
+                        self.assertEqual(
+                            inventory_api.return_value.update.call_count, 2
+                        )
+
+                # The links of a website are paged through in chunks
+                self.assertEqual(
+                    list(self.website1.iter_magento_product_templates(
+                        chunk_size=1
+                    )),
+                    [[link] for link in sorted(
+                        self.website1.magento_product_templates,
+                        key=lambda link: link.id
+                    )]
+                )
+                self.assertEqual(
+                    list(website3.iter_magento_product_templates()),
+                    [list(website3.magento_product_templates)]
+                )
+
     def test_0090_tier_prices(self):
         """Checks the function field on product price tiers
         """
         Store = POOL.get('magento.website.store')
         PriceList = POOL.get('product.price_list')
+        PriceListLine = POOL.get('product.price_list.line')
         ProductPriceTier = POOL.get('product.price_tier')
         ProductTemplate = POOL.get('product.template')
         Category = POOL.get('product.category')
@@ -451,6 +871,186 @@ class TestProduct(TestBase):
                     product_template.list_price * Decimal('0.9'), tier.price
                 )
 
+                # Prices are computed once for a price list, product,
+                # quantity and uom and then reused from the cache
+                product = product_template.products[0]
+                cache = {}
+                prices = Store.compute_price_matrix(
+                    price_list, [(product, 10), (product, 10), (product, 1)],
+                    self.website1.default_uom, cache
+                )
+                self.assertEqual(len(cache), 2)
+                self.assertEqual(prices[(product.id, 10)], tier.price)
+                self.assertEqual(
+                    prices[(product.id, 1)], product_template.list_price
+                )
+
+                cache[(
+                    price_list.id, product.id, 10, self.website1.default_uom.id
+                )] = Decimal('1')
+                prices = Store.compute_price_matrix(
+                    price_list, [(product, 10)], self.website1.default_uom,
+                    cache
+                )
+                self.assertEqual(prices[(product.id, 10)], Decimal('1'))
+
+                # The formula of a line is evaluated once for the quantities
+                # of a product it prices
+                with patch.object(
+                    PriceListLine, 'get_unit_price',
+                    return_value=Decimal('5')
+                ) as get_unit_price:
+                    prices = Store.compute_price_matrix(
+                        price_list, [(product, 10), (product, 20)],
+                        self.website1.default_uom
+                    )
+                self.assertEqual(get_unit_price.call_count, 1)
+                self.assertEqual(
+                    prices, {
+                        (product.id, 10): Decimal('5'),
+                        (product.id, 20): Decimal('5'),
+                    }
+                )
+
+                # Without price list, the prices are the list prices
+                self.assertEqual(
+                    Store.compute_price_matrix(
+                        None, [(product, 10)], self.website1.default_uom
+                    ), {(product.id, 10): product_template.list_price}
+                )
+
+                # A template without product has no price
+                template, = ProductTemplate.create([{
+                    'name': 'Template without product',
+                    'list_price': Decimal('10'),
+                    'cost_price': Decimal('5'),
+                    'default_uom': product_template.default_uom.id,
+                }])
+                tier, = ProductPriceTier.create([{
+                    'template': template.id,
+                    'quantity': 10,
+                }])
+                self.assertEqual(tier.price, 0)
+
+    def test_0095_export_tier_prices(self):
+        """
+        Checks that tier prices are exported in multiCalls and that the
+        products which magento fails to update are reported
+        """
+        Store = POOL.get('magento.website.store')
+        StorePriceTier = POOL.get('magento.store.price_tier')
+        PriceList = POOL.get('product.price_list')
+        ProductTemplate = POOL.get('product.template')
+        Category = POOL.get('product.category')
+        User = POOL.get('res.user')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            context = User.get_preferences(context_only=True)
+            context.update({
+                'magento_instance': self.instance1.id,
+                'magento_website': self.website1.id,
+                'company': self.company.id,
+            })
+            with txn.set_context(context):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                Category.create_using_magento_data(
+                    load_json('categories', '8')
+                )
+                template1 = ProductTemplate.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                ProductTemplate.find_or_create_using_magento_data(
+                    load_json('products', '17')
+                )
+
+                price_list, = PriceList.create([{
+                    'name': 'Test Pricelist',
+                    'lines': [('create', [{
+                        'quantity': 10,
+                        'formula': 'unit_price*0.9'
+                    }])]
+                }])
+                Store.write([self.store], {'price_list': price_list.id})
+                StorePriceTier.create([{
+                    'store': self.store.id,
+                    'quantity': 10,
+                }])
+
+                tier_price_api = MagicMock(spec=magento.ProductTierPrice)
+                tier_price_api.return_value.__enter__.return_value = \
+                    tier_price_api.return_value
+                fault = {
+                    'isFault': True,
+                    'faultCode': 101,
+                    'faultMessage': 'Product not exists.',
+                }
+                tier_price_api.return_value.multiCall.side_effect = \
+                    lambda calls: [
+                        fault if call[1][0] == 17 else True for call in calls
+                    ]
+
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    products_count, failures = \
+                        self.store.export_tier_prices_to_magento(chunk_size=1)
+
+                # Each product is sent in its own multiCall of one call
+                multi_call = tier_price_api.return_value.multiCall
+                self.assertEqual(multi_call.call_count, 2)
+                calls = multi_call.call_args_list[0][0][0]
+                self.assertEqual(
+                    calls[0][0], 'catalog_product_attribute_tier_price.update'
+                )
+                self.assertEqual(calls[0][1][1], [{
+                    'qty': 10,
+                    'price': float(template1.list_price * Decimal('0.9')),
+                }])
+
+                self.assertEqual(products_count, 1)
+                self.assertEqual(len(failures), 1)
+                self.assertEqual(failures[0][0].magento_id, 17)
+                self.assertEqual(failures[0][1], 'Product not exists.')
+
+                # Only the product which failed is exported again as the
+                # tier prices of the other did not change
+                multi_call.reset_mock()
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    products_count, failures = \
+                        self.store.export_tier_prices_to_magento(chunk_size=1)
+                self.assertEqual(multi_call.call_count, 1)
+                self.assertEqual(products_count, 0)
+                self.assertEqual(failures[0][0].magento_id, 17)
+
+                # Changing the price exports the product again
+                ProductTemplate.write([template1], {
+                    'list_price': template1.list_price + 1,
+                })
+                multi_call.reset_mock()
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    products_count, failures = \
+                        self.store.export_tier_prices_to_magento(chunk_size=1)
+                self.assertEqual(multi_call.call_count, 2)
+                self.assertEqual(products_count, 1)
+
+                # Forcing the export exports all the products
+                multi_call.reset_mock()
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    products_count, failures = \
+                        self.store.export_tier_prices_to_magento(
+                            chunk_size=1, force=True
+                        )
+                self.assertEqual(multi_call.call_count, 2)
+
     def test_0110_export_catalog(self):
         """
         Check the export of product catalog to magento.
@@ -489,10 +1089,56 @@ class TestProduct(TestBase):
                     }]
                 )
 
-                with patch(
-                    'magento.Product', mock_product_api(), create=True
-                ):
+                product_api = mock_product_api()
+                product_api.return_value.multiCall.return_value = [100]
+                with patch('magento.Product', product_api, create=True):
                     product.export_to_magento(category)
+                self.assertEqual(product.magento_ids[0].magento_id, 100)
+
+                # Export products in a batch
+                product2, product3 = ProductTemplate.create([{
+                    'name': 'Test product %s' % code,
+                    'list_price': Decimal('100'),
+                    'cost_price': Decimal('1'),
+                    'account_expense': self.get_account_by_kind('expense'),
+                    'account_revenue': self.get_account_by_kind('revenue'),
+                    'default_uom': uom.id,
+                    'sale_uom': uom.id,
+                    'products': [('create', [{
+                        'code': code,
+                    }])]
+                } for code in ('code2', 'code3')])
+
+                # A product already exported fails the whole batch
+                self.assertRaises(
+                    UserError, ProductTemplate.export_all_to_magento,
+                    [product, product2], category
+                )
+
+                product_api = mock_product_api()
+                handle = product_api.return_value
+                handle.multiCall.side_effect = lambda calls: [
+                    {'isFault': True, 'faultCode': 1, 'faultMessage': 'Error'}
+                    if args[2] == 'code3' else 200
+                    for _, args in calls
+                ]
+                with patch('magento.Product', product_api, create=True):
+                    exported, failures = ProductTemplate.export_all_to_magento(
+                        [product2, product3], category, chunk_size=1
+                    )
+
+                self.assertEqual(handle.multiCall.call_count, 2)
+                self.assertEqual(exported, [product2])
+                self.assertEqual(failures, [(product3, 'Error')])
+                self.assertEqual(product2.magento_ids[0].magento_id, 200)
+                self.assertEqual(product2.magento_product_type, 'simple')
+                self.assertFalse(product3.magento_ids)
+
+                # A single product refused by magento raises an error
+                with patch('magento.Product', product_api, create=True):
+                    self.assertRaises(
+                        UserError, product3.export_to_magento, category
+                    )
 
 
 def suite():
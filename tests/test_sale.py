@@ -18,7 +18,9 @@ from dateutil.relativedelta import relativedelta
 import magento
 from mock import patch, MagicMock
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
 
@@ -228,6 +230,9 @@ class TestSale(TestBase):
         Sale = POOL.get('sale.sale')
         Party = POOL.get('party.party')
         Category = POOL.get('product.category')
+        MagentoException = POOL.get('magento.exception')
+        Tax = POOL.get('account.tax')
+        StoreViewTax = POOL.get('magento.store.store_view.tax')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
             self.setup_defaults()
@@ -271,6 +276,79 @@ class TestSale(TestBase):
                     len(order.lines), len(order_data['items']) + 1
                 )
 
+                # The exception flag follows the exceptions of the sale
+                exception1, exception2 = MagentoException.create([{
+                    'origin': '%s,%s' % (order.__name__, order.id),
+                    'log': 'First exception',
+                }, {
+                    'origin': '%s,%s' % (order.__name__, order.id),
+                    'log': 'Second exception',
+                }])
+                order = Sale(order.id)
+                self.assertTrue(order.has_magento_exception)
+                self.assertEqual(
+                    Sale.get_magento_exceptions(
+                        [order], 'magento_exceptions'
+                    ),
+                    {order.id: [exception1.id, exception2.id]}
+                )
+
+                MagentoException.delete([exception1])
+                self.assertTrue(Sale(order.id).has_magento_exception)
+                MagentoException.delete([exception2])
+                order = Sale(order.id)
+                self.assertFalse(order.has_magento_exception)
+                self.assertEqual(order.magento_exceptions, ())
+
+                # The sale created meanwhile by a concurrent import of the
+                # order is returned instead of a new one
+                def conflict(sale):
+                    raise backend.get('DatabaseIntegrityError')(
+                        'duplicate key value violates unique constraint '
+                        '"sale_sale_magento_id_instance_unique"'
+                    )
+
+                with Transaction().set_context(company=self.company):
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        with patch.object(Sale, 'save', conflict):
+                            self.assertEqual(
+                                Sale.create_using_magento_data(order_data),
+                                order
+                            )
+                self.assertEqual(len(Sale.search([])), 1)
+
+                # The taxes of the lines are found from the store view
+                # passed down, without looking up the current store view
+                self.StoreView.clear_tax_rate_cache()
+                tax, = Tax.create([{
+                    'name': 'Tax',
+                    'description': 'Tax',
+                    'type': 'none',
+                    'company': self.company.id,
+                }])
+                StoreViewTax.create([{
+                    'store_view': self.store_view.id,
+                    'tax_percent': Decimal('0.0825'),
+                    'taxes': [('add', [tax.id])],
+                }])
+                with patch.object(
+                    self.StoreView, 'get_current_store_view',
+                    side_effect=AssertionError
+                ):
+                    sale_line = order.get_sale_line_using_magento_data(
+                        dict(order_data['items'][0], tax_percent='8.2500'),
+                        self.store_view
+                    )
+                self.assertEqual(list(sale_line.taxes), [tax])
+                self.StoreView.clear_tax_rate_cache()
+
+                # The store view must belong to the instance of the sale
+                with self.assertRaises(UserError):
+                    Sale.write([order], {
+                        'magento_instance': self.instance2.id,
+                    })
+
     def test_0035_import_sale_order_with_products_with_processing(self):
         """
         Tests import of sale order using magento data with magento state as
@@ -373,6 +451,67 @@ class TestSale(TestBase):
                 self.assertEqual(
                     len(order.lines), len(order_data['items']) + 1
                 )
+                self.assertEqual(
+                    order.magento_increment_id, order_data['increment_id']
+                )
+
+                # Changing the order prefix does not affect the lookup
+                self.instance1.order_prefix = 'new_'
+                self.instance1.save()
+                self.assertEqual(
+                    Sale.find_using_magento_increment_id(
+                        order_data['increment_id']
+                    ), order
+                )
+
+    def test_0045_import_guest_orders(self):
+        """
+        Tests that guest orders use the party of an earlier guest customer
+        with the same email only if the store view is set to merge them
+        """
+        Sale = POOL.get('sale.sale')
+        Party = POOL.get('party.party')
+        MagentoParty = POOL.get('magento.website.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'magento_instance': self.instance1.id,
+                'magento_store_view': self.store_view.id,
+                'magento_website': self.website1.id,
+                'company': self.company.id,
+            }):
+                order_data = load_json('orders', '100000001')
+                order_data['customer_id'] = None
+
+                party1 = Sale.get_sale_using_magento_data(order_data).party
+                party2 = Sale.get_sale_using_magento_data(order_data).party
+                self.assertNotEqual(party1, party2)
+
+                self.store_view.merge_guest_customers = True
+                self.store_view.save()
+
+                order_data['customer_email'] = ' %s ' % (
+                    order_data['customer_email'].upper()
+                )
+                party3 = Sale.get_sale_using_magento_data(order_data).party
+                self.assertEqual(party3, party1)
+                self.assertEqual(
+                    Party.find_guest_using_magento_email(
+                        order_data['customer_email']
+                    ), party1
+                )
+
+                order_data['customer_email'] = 'other@example.com'
+                party4 = Sale.get_sale_using_magento_data(order_data).party
+                self.assertNotIn(party4, (party1, party2))
+                magento_party, = party4.magento_ids
+                self.assertEqual(magento_party.magento_id, 0)
+                self.assertEqual(magento_party.email, 'other@example.com')
+                self.assertEqual(
+                    MagentoParty.search([('magento_id', '=', 0)], count=True),
+                    3
+                )
 
     def test_0050_export_order_status_to_magento(self):
         """
@@ -417,23 +556,41 @@ class TestSale(TestBase):
                 self.assertEqual(len(Sale.search([])), 1)
 
                 with patch('magento.Order', mock_order_api(), create=True):
+                    # The order was canceled on magento, so its state is not
+                    # sent back
+                    self.assertEqual(
+                        self.store_view.export_order_status_for_store_view(),
+                        []
+                    )
+
+                    # Canceling it in tryton is exported
+                    Sale.draft([order])
+                    Sale.cancel([order])
                     order_exported = \
                         self.store_view.export_order_status_for_store_view()
 
                     self.assertEqual(len(order_exported), 1)
                     self.assertEqual(order_exported[0], order)
 
-    def test_0060_export_order_status_with_last_order_export_time_case1(self):
+    def test_0060_export_order_status_only_once(self):
         """
-        Tests that sale cannot be exported if last order export time is
-        greater than sale's write date
+        Tests that the state change of a sale is exported only once and only
+        for the store view of the sale
         """
         Sale = POOL.get('sale.sale')
         Category = POOL.get('product.category')
+        StateChange = POOL.get('magento.sale.state_change')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
             self.setup_defaults()
 
+            store_view2, = self.StoreView.create([{
+                'name': 'Store view2',
+                'magento_id': 2,
+                'store': self.store,
+                'code': '456',
+            }])
+
             with Transaction().set_context({
                 'magento_instance': self.instance1.id,
                 'magento_store_view': self.store_view.id,
@@ -443,9 +600,6 @@ class TestSale(TestBase):
                 category_tree = load_json('categories', 'category_tree')
                 Category.create_tree_using_magento_data(category_tree)
 
-                orders = Sale.search([])
-                self.assertEqual(len(orders), 0)
-
                 order_data = load_json('orders', '100000001-draft')
 
                 with patch(
@@ -463,21 +617,32 @@ class TestSale(TestBase):
                         )
 
                 self.assertEqual(order.state, 'cancel')
-                self.assertEqual(len(Sale.search([])), 1)
 
-                export_date = datetime.utcnow() + relativedelta(days=1)
-                self.StoreView.write([self.store_view], {
-                    'last_order_export_time': export_date
-                })
+                # The cancellation was imported from magento
+                self.assertEqual(StateChange.search([]), [])
 
-                self.assertTrue(
-                    self.store_view.last_order_export_time > order.write_date
-                )
+                Sale.draft([order])
+                Sale.cancel([order])
+
+                state_change, = StateChange.search([])
+                self.assertEqual(state_change.sale, order)
+                self.assertEqual(state_change.state, 'cancel')
+                self.assertFalse(state_change.exported)
 
                 with patch('magento.Order', mock_order_api(), create=True):
+                    # Sales of other store views are not exported
+                    self.assertEqual(
+                        store_view2.export_order_status_for_store_view(), []
+                    )
+
                     order_exported = \
                         self.store_view.export_order_status_for_store_view()
+                    self.assertEqual(order_exported, [order])
+                    self.assertTrue(StateChange(state_change.id).exported)
 
+                    # Nothing changed since the last export
+                    order_exported = \
+                        self.store_view.export_order_status_for_store_view()
                     self.assertEqual(len(order_exported), 0)
 
     def test_0050_export_shipment(self):
@@ -595,10 +760,11 @@ class TestSale(TestBase):
                         True
                     )
 
-    def test_0070_export_order_status_with_last_order_export_time_case2(self):
+    def test_0070_export_order_status_ignores_last_order_export_time(self):
         """
-        Tests that sale can be exported if last order export time is
-        smaller than sale's write date
+        Tests that the state change of a sale is exported even if the last
+        order export time is later than the write date of the sale, as only
+        the journal of state changes drives the export
         """
         Sale = POOL.get('sale.sale')
         Category = POOL.get('product.category')
@@ -637,13 +803,17 @@ class TestSale(TestBase):
                 self.assertEqual(order.state, 'cancel')
                 self.assertEqual(len(Sale.search([])), 1)
 
-                export_date = datetime.utcnow() - relativedelta(days=1)
+                Sale.draft([order])
+                Sale.cancel([order])
+
+                export_date = datetime.utcnow() + relativedelta(days=1)
                 self.StoreView.write([self.store_view], {
                     'last_order_export_time': export_date
                 })
 
                 self.assertTrue(
-                    self.store_view.last_order_export_time < order.write_date
+                    self.store_view.last_order_export_time >
+                    Sale(order.id).write_date
                 )
 
                 with patch('magento.Order', mock_order_api(), create=True):
@@ -728,6 +898,8 @@ class TestSale(TestBase):
         ProductTemplate = POOL.get('product.template')
         Category = POOL.get('product.category')
         MagentoOrderState = POOL.get('magento.order_state')
+        Product = POOL.get('product.product')
+        Bom = POOL.get('production.bom')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
             self.setup_defaults()
@@ -780,6 +952,64 @@ class TestSale(TestBase):
                 self.assertEqual(len(product.boms), 1)
                 self.assertEqual(len(product.boms[0].bom.inputs), 2)
 
+                # A BoM created before signatures were stored is matched
+                # and signed on the next lookup
+                bom = product.boms[0].bom
+                signature = bom.magento_signature
+                self.assertTrue(signature)
+                Bom.write([bom], {'magento_signature': None})
+                with patch('magento.Product', mock_product_api(), create=True):
+                    Bom.find_or_create_bom_for_magento_bundle(order_data)
+                product = Product(product.id)
+                self.assertEqual(len(product.boms), 1)
+                self.assertEqual(
+                    product.boms[0].bom.magento_signature, signature
+                )
+
+                # A BoM created by hand with other outputs is not signed
+                ProductBom = POOL.get('product.product-production.bom')
+                unit = product.default_uom
+                manual_bom, = Bom.create([{
+                    'name': 'Manual BoM',
+                    'inputs': [('create', [{
+                        'uom': unit.id,
+                        'product': bom.inputs[0].product.id,
+                        'quantity': 2,
+                    }])],
+                    'outputs': [('create', [{
+                        'uom': unit.id,
+                        'product': product.id,
+                        'quantity': 1,
+                    }, {
+                        'uom': unit.id,
+                        'product': bom.inputs[1].product.id,
+                        'quantity': 1,
+                    }])],
+                }])
+                ProductBom.create([{
+                    'product': product.id,
+                    'bom': manual_bom.id,
+                }])
+                self.assertIsNone(Bom.find_using_magento_signature(
+                    Product(product.id), 'unknown'
+                ))
+                self.assertIsNone(Bom(manual_bom.id).magento_signature)
+
+                # Signatures do not depend on the order of the components or
+                # on rounding differences of the quantities
+                self.assertEqual(
+                    Bom.get_magento_signature(1, [
+                        (2, Decimal('1') / Decimal('3')), (3, 2.0),
+                    ]),
+                    Bom.get_magento_signature(1, [
+                        (3, Decimal('2.0000')), (2, 2.0 / 6.0),
+                    ])
+                )
+                self.assertNotEqual(
+                    Bom.get_magento_signature(1, [(2, 1)]),
+                    Bom.get_magento_signature(4, [(2, 1)])
+                )
+
     def test_0100_import_sale_with_bundle_plus_child_separate(self):
         """
         Tests import of sale order with bundle product using magento data
@@ -11,6 +11,8 @@ import sys
 import os
 
 import unittest
+from mock import patch, MagicMock
+
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from test_base import TestBase, load_json
@@ -122,6 +124,65 @@ class TestWebsiteImport(TestBase):
                     store_views_after_import > store_views_before_import
                 )
 
+    def test_0040_import_websites_hierarchy(self):
+        """
+        Tests the import of websites, stores and store views of an instance
+        fetched in a single session, bypassing the metadata cache
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            with txn.set_context({'company': self.company.id}):
+                instance, = self.Instance.create([{
+                    'name': 'Test Instance',
+                    'url': 'some test url',
+                    'api_user': 'admin',
+                    'api_key': 'testkey',
+                    'default_account_expense':
+                        self.get_account_by_kind('expense'),
+                    'default_account_revenue':
+                        self.get_account_by_kind('revenue'),
+                }])
+                self.Instance.clear_metadata_cache([instance])
+
+                store_view_data = load_json('core', 'store_view')
+                core_api = MagicMock()
+                handle = core_api.return_value.__enter__.return_value
+                handle.websites.return_value = [load_json('core', 'website')]
+                handle.stores.return_value = [load_json('core', 'store')]
+                handle.store_views.return_value = [
+                    store_view_data,
+                    dict(store_view_data, store_id='2', code='french'),
+                ]
+                order_config_api = MagicMock()
+                order_config_api.return_value.__enter__.return_value \
+                    .get_states.return_value = {}
+
+                magento_module = sys.modules['trytond.modules.magento.magento_']
+                with patch.object(magento_module, 'Core', core_api):
+                    with patch.object(
+                        magento_module, 'OrderConfig', order_config_api
+                    ):
+                        self.Instance.import_websites([instance])
+                        self.Instance.import_websites([instance])
+
+                        # Each import fetches the data again in a single session
+                        self.assertEqual(core_api.call_count, 2)
+                        self.assertEqual(handle.stores.call_count, 2)
+                        self.assertEqual(handle.store_views.call_count, 2)
+
+                        # The data fetched by the button refreshes the
+                        # cache, which the other imports read from
+                        instance.import_websites_from_magento()
+                        self.assertEqual(core_api.call_count, 2)
+                        self.assertEqual(order_config_api.call_count, 1)
+
+                website, = self.Website.search([('instance', '=', instance)])
+                store, = website.stores
+                self.assertEqual(
+                    sorted(view.magento_id for view in store.store_views),
+                    [1, 2]
+                )
+
 
 def suite():
     """